@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Map canvas items used by the Brush Tool.
+
+These items paint directly in device pixels and never touch GEOS, so the cost
+of repainting them does not depend on how complex the stroke geometry is.
+"""
+from functools import lru_cache
+
+from qgis.gui import QgsMapCanvasItem
+from qgis.core import QgsPointXY, QgsRectangle
+
+from qgis.PyQt.QtCore import Qt, QPointF
+from qgis.PyQt.QtGui import QColor, QCursor, QPainter, QPainterPath, QPen, \
+    QPixmap, QPolygonF, QTransform
+
+from .strokes import shape_template
+
+# Largest cursor (in pixels) that is rendered as a pixmap. Larger brushes use
+# a cross cursor together with a BrushOutlineItem, since many platforms cannot
+# show big cursors.
+MAX_CURSOR_SIZE = 128
+
+
+def brush_outline_path(shape, radius, angle):
+    """Build the outline of a brush as a vector path.
+
+    Args:
+        shape: A string of the name of the brush shape.
+        radius: A float representing the radius of the brush in pixels.
+        angle: A float representing the angle of the brush in degrees,
+            clockwise as seen on screen.
+
+    Returns:
+        A QPainterPath in pixels, centered on the origin.
+    """
+    path = QPainterPath()
+    if shape == 'circle':
+        path.addEllipse(QPointF(0, 0), radius, radius)
+    else:
+        # Templates are y-up, screen coordinates are y-down
+        path.addPolygon(QPolygonF([QPointF(x*radius, -y*radius)
+                                   for x, y in shape_template(shape, 0)]))
+        path.closeSubpath()
+    return QTransform().rotate(angle).map(path)
+
+
+def paint_outline(painter, path):
+    """Paint the outline of a brush so that it is visible on any background."""
+    painter.setRenderHint(QPainter.Antialiasing, True)
+    painter.strokePath(path, QPen(QColor(255, 255, 255, 200), 3))
+    painter.strokePath(path, QPen(QColor(0, 0, 0, 220), 1))
+
+
+@lru_cache(maxsize=64)
+def brush_cursor(shape, radius, angle):
+    """Render a cursor showing the outline of a brush.
+
+    Cursors are cached, so callers should round radius and angle to buckets
+    to keep the number of distinct cursors small.
+
+    Args:
+        shape: A string of the name of the brush shape.
+        radius: An integer representing the radius of the brush in pixels.
+        angle: An integer representing the angle of the brush in degrees.
+
+    Returns:
+        A QCursor with its hot spot at the center of the brush.
+    """
+    size = 2*radius + 4
+    pixmap = QPixmap(size, size)
+    pixmap.fill(Qt.transparent)
+
+    painter = QPainter(pixmap)
+    painter.translate(size / 2, size / 2)
+    paint_outline(painter, brush_outline_path(shape, radius, angle))
+    painter.end()
+
+    return QCursor(pixmap, size // 2, size // 2)
+
+
+class StrokePreviewItem(QgsMapCanvasItem):
+    """Map canvas item that previews the stroke currently being drawn.
+
+    Circular strokes are kept as a QPainterPath along the centreline that is
+    stroked with a round pen as wide as the brush. All other strokes are kept
+    as a QPainterPath of the swept brush shapes, filled with the winding rule.
+    Both paths are stored in map units relative to the first sample of the
+    stroke and are only transformed to device pixels when painting. Swept
+    shapes that have already been merged into a polygon are kept in a third
+    path, filled with the odd-even rule so that holes stay open.
+
+    Attributes:
+        canvas: The QgsMapCanvas the item is drawn on.
+        color: The QColor used to paint the stroke.
+        width: A float representing the brush diameter in map units.
+
+    Methods:
+        setColor: Set the color used to paint the stroke.
+        start: Start a new stroke at a given point.
+        add_point: Extend the centreline of the stroke to a given point.
+        move_to: Start a new piece of the centreline at a given point.
+        add_polygon: Add a swept brush shape to the stroke.
+        rebuild: Replace the paths after the stroke was simplified.
+        reset: Erase the stroke and hide the item.
+        paint: Paint the stroke onto the map canvas.
+    """
+
+    def __init__(self, canvas):
+        """Constructor for the stroke preview item.
+
+        Args:
+            canvas: The QgsMapCanvas on which the stroke is previewed.
+        """
+        QgsMapCanvasItem.__init__(self, canvas)
+        self.canvas = canvas
+        self.color = QColor(0, 0, 255, 127)
+        self.width = 0
+        self.reset()
+
+    def setColor(self, color):
+        """Set the QColor used to paint the stroke."""
+        self.color = QColor(color)
+        self.update()
+
+    def start(self, point, width):
+        """Start a new stroke.
+
+        Args:
+            point: A QgsPointXY indicating the first sample of the stroke.
+            width: A float representing the brush diameter in map units.
+        """
+        self.reset()
+        self.width = width
+        self.origin = QgsPointXY(point)
+        self.extent = QgsRectangle(point.x(), point.y(), point.x(), point.y())
+        self.show()
+
+    def add_point(self, point):
+        """Extend the centreline of the stroke to a given point.
+
+        Args:
+            point: A QgsPointXY indicating the new position of the brush.
+        """
+        local_point = self._to_local(point.x(), point.y())
+        if self.line_path.elementCount() == 0:
+            # A zero-length segment is drawn as a dot by the round pen cap
+            self.line_path.moveTo(local_point)
+        self.line_path.lineTo(local_point)
+        self._grow(point.x(), point.y(), self.width / 2)
+
+    def move_to(self, point):
+        """Start a new piece of the centreline at a given point, without
+        joining it to the previous sample.
+
+        Args:
+            point: A QgsPointXY indicating the new position of the brush.
+        """
+        self.line_path.moveTo(self._to_local(point.x(), point.y()))
+
+    def add_polygon(self, vertices):
+        """Add a swept brush shape to the stroke.
+
+        Args:
+            vertices: A sequence of (x, y) pairs, such as a numpy array of
+                shape (n, 2), making up the exterior ring of the swept brush
+                shape.
+        """
+        polygon = QPolygonF([self._to_local(x, y) for x, y in vertices])
+        self.fill_path.addPolygon(polygon)
+        self.fill_path.closeSubpath()
+
+        xs = [x for x, y in vertices]
+        ys = [y for x, y in vertices]
+        self.extent.combineExtentWith(QgsRectangle(min(xs), min(ys),
+                                                   max(xs), max(ys)))
+        self.setRect(self.extent)
+        self.update()
+
+    def rebuild(self, runs, rings, polygons):
+        """Replace the paths after the stroke was simplified.
+
+        The item rectangle is left as it is, since simplification never moves
+        the stroke outside of it.
+
+        Args:
+            runs: A list of sequences of (x, y) pairs making up the pieces of
+                the centreline.
+            rings: A list of sequences of (x, y) pairs making up the rings of
+                the swept shapes that have already been merged.
+            polygons: A list of sequences of (x, y) pairs making up the swept
+                brush shapes that have not been merged yet.
+        """
+        self.line_path = QPainterPath()
+        for run in runs:
+            points = [self._to_local(x, y) for x, y in run]
+            self.line_path.moveTo(points[0])
+            for point in points:
+                self.line_path.lineTo(point)
+
+        self.settled_path = QPainterPath()
+        self.settled_path.setFillRule(Qt.OddEvenFill)
+        for ring in rings:
+            self.settled_path.addPolygon(
+                QPolygonF([self._to_local(x, y) for x, y in ring]))
+            self.settled_path.closeSubpath()
+
+        self.fill_path = QPainterPath()
+        self.fill_path.setFillRule(Qt.WindingFill)
+        for vertices in polygons:
+            self.fill_path.addPolygon(
+                QPolygonF([self._to_local(x, y) for x, y in vertices]))
+            self.fill_path.closeSubpath()
+
+        self.update()
+
+    def reset(self):
+        """Erase the stroke and hide the item."""
+        self.origin = None
+        self.extent = None
+        self.line_path = QPainterPath()
+        self.fill_path = QPainterPath()
+        self.fill_path.setFillRule(Qt.WindingFill)
+        self.settled_path = QPainterPath()
+        self.settled_path.setFillRule(Qt.OddEvenFill)
+        self.hide()
+
+    def paint(self, painter, option=None, widget=None):
+        """Paint the stroke in device pixels."""
+        if self.origin is None:
+            return
+
+        origin = self.toCanvasCoordinates(self.origin) - self.pos()
+        map_units_per_pixel = self.canvas.mapUnitsPerPixel()
+
+        painter.save()
+        painter.setRenderHint(QPainter.Antialiasing, True)
+        painter.translate(origin)
+        painter.rotate(self.canvas.rotation())
+        painter.scale(1 / map_units_per_pixel, -1 / map_units_per_pixel)
+
+        if not self.settled_path.isEmpty():
+            painter.fillPath(self.settled_path, self.color)
+
+        if not self.fill_path.isEmpty():
+            painter.fillPath(self.fill_path, self.color)
+
+        if not self.line_path.isEmpty():
+            pen = QPen(self.color, self.width, Qt.SolidLine, Qt.RoundCap,
+                       Qt.RoundJoin)
+            painter.strokePath(self.line_path, pen)
+
+        painter.restore()
+
+    def _to_local(self, x, y):
+        """Convert map coordinates to coordinates relative to the origin."""
+        return QPointF(x - self.origin.x(), y - self.origin.y())
+
+    def _grow(self, x, y, margin):
+        """Grow the item rectangle so that it covers a point and a margin."""
+        self.extent.combineExtentWith(QgsRectangle(
+            x - margin, y - margin, x + margin, y + margin))
+        self.setRect(self.extent)
+        self.update()
+
+
+class BrushOutlineItem(QgsMapCanvasItem):
+    """Map canvas item that shows the outline of the brush around the mouse
+    pointer, for brushes too large to be shown as a cursor.
+
+    Like QgsVertexMarker, the item is anchored to a point in map coordinates
+    and paints in device pixels around it.
+
+    Attributes:
+        center: The QgsPointXY around which the outline is drawn, or None.
+        path: The QPainterPath of the outline, in pixels around the center.
+
+    Methods:
+        set_brush: Update the outline to a brush shape, radius and angle.
+        set_center: Move the outline to a point.
+        updatePosition: Keep the outline on its center when the map moves.
+        boundingRect: Return the area painted by the item.
+        paint: Paint the outline onto the map canvas.
+    """
+
+    def __init__(self, canvas):
+        """Constructor for the brush outline item.
+
+        Args:
+            canvas: The QgsMapCanvas on which the outline is drawn.
+        """
+        QgsMapCanvasItem.__init__(self, canvas)
+        self.center = None
+        self.path = QPainterPath()
+        self.hide()
+
+    def set_brush(self, shape, radius, angle):
+        """Update the outline to a brush shape, radius (in pixels) and angle
+        (in degrees)."""
+        self.prepareGeometryChange()
+        self.path = brush_outline_path(shape, radius, angle)
+        self.update()
+
+    def set_center(self, point):
+        """Move the outline to a QgsPointXY in map coordinates."""
+        self.center = QgsPointXY(point)
+        self.updatePosition()
+
+    def updatePosition(self):
+        """Keep the outline on its center when the map extent changes."""
+        if self.center is not None:
+            self.setPos(self.toCanvasCoordinates(self.center))
+
+    def boundingRect(self):
+        """Return the area painted by the item, in item coordinates."""
+        return self.path.boundingRect().adjusted(-2, -2, 2, 2)
+
+    def paint(self, painter, option=None, widget=None):
+        """Paint the outline in device pixels."""
+        if self.center is None:
+            return
+        paint_outline(painter, self.path)
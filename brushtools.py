@@ -25,24 +25,32 @@ from __future__ import print_function
 from builtins import str
 from builtins import range
 
-from qgis.gui import QgsMapTool, QgsRubberBand, QgsMapToolEmitPoint, \
+from qgis.gui import QgsMapTool, QgsMapToolEmitPoint, \
     QgsProjectionSelectionDialog
-from qgis.core import QgsWkbTypes, QgsPointXY, QgsPoint, QgsGeometry, \
-    QgsRenderContext, QgsLineString, QgsCoordinateTransform, QgsProject
+from qgis.core import QgsPoint, QgsGeometry
 
-from qgis.PyQt.QtCore import Qt, QCoreApplication, pyqtSignal, QPoint
+from qgis.PyQt.QtCore import Qt, QCoreApplication, QSettings, pyqtSignal, \
+    QPoint, QTimer
 from qgis.PyQt.QtWidgets import QDialog, QLineEdit, QDialogButtonBox, \
     QGridLayout, QLabel, QGroupBox, QVBoxLayout, QComboBox, QPushButton, \
     QInputDialog, QApplication, QShortcut
 from qgis.PyQt.QtGui import QDoubleValidator, QIntValidator, QKeySequence, \
-    QPixmap, QCursor, QPainter, QColor, QTransform
+    QCursor, QPainter, QColor
 
-from math import sqrt, pi, cos, sin
+from functools import partial
+from weakref import WeakSet
+from math import sqrt, ceil
 
 from PyQt5.QtGui import QGuiApplication
 
-# Initialize Qt resources from file resources.py
-from .resources import *
+from .connections import ConnectionRegistry
+from .brushitems import StrokePreviewItem, BrushOutlineItem, brush_cursor, \
+    MAX_CURSOR_SIZE
+from .reprojection import CrsContext, transform_vertices
+from .strokemask import StrokeMask
+from .strokes import StrokeAccumulator, StrokeSampler, CoverageGrid, \
+    stamp_vertices, polygon_from_vertices, inner_radius, points_for_radius, \
+    swept_hull
 
 class BrushTool(QgsMapTool):
     """Custom QgsMapTool to simulate drawing with a brush.
@@ -55,17 +63,61 @@ class BrushTool(QgsMapTool):
         brush_radius: An integer number representing the radius of the brush 
             in pixels.
         brush_points: An integer number of points to use when approximating a
-            circle.
+            circle, derived from brush_radius and brush_tolerance by
+            update_level_of_detail.
+        brush_tolerance: A float representing the maximum distance in pixels
+            between the drawn geometry and the exact brush shape.
         brush_angle: A float representing the angle of the brush.
         brush_shapes: A list of strings indicating the names of the shapes the
             brush can take.
         brush_shape: A string of the name of the current shape of the brush.
-        draw_color: The QColor to use for rendering the QgsRubberBand when in
+        draw_color: The QColor to use for rendering the stroke preview when in
             drawing mode.
-        erase_color: The QColor to use for rendering the QgsRubberBand when in
-            erasing mode.
-        t: The QgsCoordinateTransform to be used in reprojecting the geometry
-            from QgsRubberBand to the CRS of self.active_layer.
+        erase_color: The QColor to use for rendering the stroke preview when
+            in erasing mode.
+        t: The QgsCoordinateTransform to be used in reprojecting the stroke
+            geometry to the CRS of self.active_layer.
+        crs_contexts: A dict caching a CrsContext (transform and local scale
+            factors) for each pair of project and layer CRS authids.
+        crs_context: The CrsContext for self.active_layer, or None if no
+            reprojection is necessary.
+        map_units_per_pixel: A float caching the number of map units per
+            screen pixel of the map canvas, kept up to date by
+            update_scale_cache.
+        scale_cache_refreshes: An integer counting how many times
+            map_units_per_pixel was read from the canvas map settings.
+        sample_spacing: A float representing the minimum distance between two
+            recorded mouse moves, as a fraction of brush_radius, read from the
+            'class_labeler/sample_spacing' setting.
+        vertex_budget: An integer number of vertices the stroke currently
+            being drawn may hold before it is simplified more coarsely.
+        stroke_engines: A list of strings indicating the names of the engines
+            that can record strokes: 'vector' (StrokeAccumulator) or 'raster'
+            (StrokeMask).
+        stroke_engine: A string of the name of the engine used for the
+            session, read from the 'class_labeler/stroke_engine' setting.
+        raster_cell_size: A float representing the size in pixels of the
+            cells of the raster engine.
+        sampler: The StrokeSampler deciding which mouse moves are recorded.
+            Its counters are reset for every stroke, so its keep_ratio method
+            reports the fraction of moves kept in the last stroke.
+        flush_timer: A single-shot QTimer coalescing the mouse moves received
+            within one frame into a single recorded move.
+        pending_position: The QPoint of the latest accepted mouse move that
+            has not been recorded yet, or None.
+        latest_position: The QPoint of the latest mouse move of the stroke.
+        recorded_position: The QPoint of the last recorded mouse move.
+        projection_timer: A single-shot QTimer reprojecting the samples of the
+            stroke in batches while it is drawn, when reprojecting.
+        coverage: The CoverageGrid recording the screen area already painted
+            by the stroke currently being drawn, or None.
+        coverage_skips: An integer counting the recorded mouse moves that were
+            skipped because the area they sweep was already painted.
+        stroke_radius: A float representing the brush radius in pixels when
+            the stroke currently being drawn started. Resizing the brush only
+            applies to the next stroke.
+        stroke_painted_radius: The painted_radius of the brush when the
+            stroke currently being drawn started.
         drawing_mode: A string indicating the current mode of the Brush Tool.
         merging: A boolean indicating whether the geometry currently being
             drawn must be merged with other features in the active layer.
@@ -74,17 +126,41 @@ class BrushTool(QgsMapTool):
             of the active layer.
         tab_shortcut: A QShortcut that binds the tab key to the method that
             changes the brush shape.
-        rb: The QgsRubberBand containing the geometry currently being drawn.
+        pending_shape_switches: An integer counting the shape switches
+            requested while a stroke is drawn, applied once it is reset.
+        preview: The StrokePreviewItem painting the stroke currently being
+            drawn.
+        outline: The BrushOutlineItem showing the brush around the mouse
+            pointer when the brush is too large to be shown as a cursor.
+        cursor_angle_step: An integer number of degrees to which the brush
+            angle is rounded when rendering the cursor.
+        stroke: The StrokeAccumulator recording the samples of the stroke
+            currently being drawn, or None when no stroke is in progress.
         previous_point: A QgsPointXY indicating the last recorded position of
             the mouse pointer.
-        previous_geometry: A QgsGeometry containing the last recorded brush
-            shape, to be used only with non-circle brushes.
+        previous_vertices: A numpy array containing the vertices of the last
+            recorded brush shape, to be used only with non-circle brushes.
+        instances: A class-level WeakSet of the BrushTool instances alive,
+            used to check that tools are not piling up.
+        connections: The ConnectionRegistry through which the tool connects
+            to the map canvas signals while it is active.
 
     Methods:
-        activate: Make the brush tool cursor whenever tool is activated.
-        deactivate: Reset the rubber band and disable the tab shortcut whenever
+        activate: Make the brush tool cursor and enable the tab shortcut
+            whenever tool is activated.
+        deactivate: Reset the stroke preview and disable the tab shortcut whenever
             the tool is deactivated.
-        make_cursor: Render the cursor using brush shape and size attributes.
+        teardown: Remove the canvas items and shortcut owned by the tool.
+        make_cursor: Show the brush outline, as a cached cursor or as a canvas
+            item, using brush shape and size attributes.
+        update_level_of_detail: Derive brush_points from the on-screen size of
+            the brush.
+        buffer_segments: Return the number of segments per quarter circle
+            matching brush_points.
+        update_scale_cache: Refresh map_units_per_pixel from the map canvas
+            whenever its scale, extent or CRS changes.
+        invalidate_crs_contexts: Mark the cached scale factors of every
+            CrsContext as stale whenever the map extent or CRS changes.
         switch_brush_shape: Switch the brush to the next possible shape.
         check_coordinate_systems: Check that the active layer is in the same
             CRS as the project instance, and if not, modify the relevant
@@ -92,37 +168,60 @@ class BrushTool(QgsMapTool):
         reset: Erase data in geometric attributes when the tool is reset.
         wheelEvent: When the user scrolls their mouse wheel, check for Shift 
             and Ctrl modifiers and update the cursor accordingly.
-        canvasPressEvent: Create initial rubber band geometry based on current
-            mouse position.
-        canvasMoveEvent: Update rubber band geometry based on mouse movement.
-        canvasReleaseEvent: Process rubber band geometry (simplify, reproject 
-            if necessary) and then emit it for drawing into the active layer.
+        canvasPressEvent: Start recording the stroke at the current mouse
+            position.
+        canvasMoveEvent: Queue mouse moves that are far enough apart to be
+            recorded.
+        flush_pending_move: Record the latest queued mouse move.
+        project_pending_samples: Reproject the swept shapes of the stroke
+            recorded since the last batch.
+        record_move: Record the stroke and extend the stroke preview at a
+            given point.
+        canvasReleaseEvent: Build the stroke geometry, process it (simplify,
+            reproject if necessary) and then emit it for drawing into the
+            active layer.
+        painted_radius: Return the radius of the circle always painted by the
+            current brush shape.
         circle_around_point: Calculate a circle geometry around a given point.
         wedge_around_point: Calculate a wedge geometry around a given point.
+        rectangle_around_point: Calculate a rectangle geometry around a given
+            point.
+        shape_around_point: Calculate the geometry of any brush shape around
+            a given point.
+        vertices_around_point: Calculate the vertices of any brush shape
+            around a given point.
 
     """
     # Make signals for movement and end of selection and end of drawing
     rb_finished = pyqtSignal(QgsGeometry)
 
+    # Keep track of the live instances for diagnostics
+    instances = WeakSet()
+
     #------------------------------ INITIALIZATION ----------------------------
-    def __init__(self, iface):
+    def __init__(self, iface, connections=None):
         """Constructor for the Brush Tool.
 
         Args:
             iface: A QgsInterface instance which provides the hook by which the
                 class can manipulate the QGIS application at run time.
+            connections: An optional ConnectionRegistry shared with the rest
+                of the plugin. Defaults to None, which creates a new one.
         """
         # Initialize the parent class
         QgsMapTool.__init__(self, iface.mapCanvas())
+        BrushTool.instances.add(self)
 
         # Save references to QGIS interface and current active layer
         self.iface = iface
         self.canvas = iface.mapCanvas()
         self.active_layer = iface.activeLayer()
+        self.connections = connections or ConnectionRegistry()
 
         # Set other instance attributes
         self.brush_radius = 120                 # default brush parameters
-        self.brush_points = 24
+        self.brush_tolerance = 0.5
+        self.update_level_of_detail()
         self.brush_angle = 0
         self.brush_shapes = ['circle', 'wedge', 'rectangle']
         self.brush_shape = self.brush_shapes[0]
@@ -131,6 +230,38 @@ class BrushTool(QgsMapTool):
         self.erase_color = QColor(255,0,0,127)
 
         self.t = None                            # coordinate transform
+        self.crs_contexts = {}
+        self.crs_context = None
+
+        self.map_units_per_pixel = 0             # scale cache
+        self.scale_cache_refreshes = 0
+
+        try:                                     # mouse move sampling
+            self.sample_spacing = float(QSettings().value(
+                'class_labeler/sample_spacing', 0.05))
+        except (TypeError, ValueError):
+            self.sample_spacing = 0.05
+        self.sampler = StrokeSampler()
+        self.vertex_budget = 5000                # streaming simplification
+
+        self.stroke_engines = ['vector', 'raster']   # stroke engine
+        self.stroke_engine = QSettings().value('class_labeler/stroke_engine',
+                                               'vector')
+        if self.stroke_engine not in self.stroke_engines:
+            self.stroke_engine = self.stroke_engines[0]
+        self.raster_cell_size = 1
+        self.flush_timer = QTimer()
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(16)         # about one frame at 60 Hz
+        self.flush_timer.timeout.connect(self.flush_pending_move)
+
+        self.projection_timer = QTimer()         # incremental reprojection
+        self.projection_timer.setSingleShot(True)
+        self.projection_timer.setInterval(100)
+        self.projection_timer.timeout.connect(self.project_pending_samples)
+
+        self.coverage = None                     # painted area of the stroke
+        self.coverage_skips = 0
 
         # Set flags
         self.drawing_mode = 'inactive'
@@ -140,44 +271,118 @@ class BrushTool(QgsMapTool):
         # Set shortcuts
         self.tab_shortcut = QShortcut(QKeySequence(Qt.Key_Tab), self.iface.mainWindow())
         self.tab_shortcut.activated.connect(self.switch_brush_shape)
+        self.pending_shape_switches = 0
         
         # Check if reprojection is necessary and if so update flags and attributes
         self.check_coordinate_systems()
         
-        # Configure rubberband for drawing
-        self.rb = QgsRubberBand(self.canvas, QgsWkbTypes.PolygonGeometry)
-        self.rb.setWidth(1)
+        # Fill the scale cache
+        self.update_scale_cache()
+
+        # Configure the stroke preview for drawing
+        self.preview = StrokePreviewItem(self.canvas)
+
+        # Configure the brush outline for large brushes
+        self.outline = BrushOutlineItem(self.canvas)
+        self.cursor_angle_step = 2
 
-        # Reset the rubberband
+        # Reset the stroke preview
         self.reset()
 
     #------------------------------- ACTIVATION -------------------------------
     def activate(self):
-        """Make the brush tool cursor whenever tool is activated."""
+        """Make the brush tool cursor, enable the tab shortcut and start
+        tracking the canvas scale whenever tool is activated.
+
+        The extent may have changed while another tool was active, so the
+        cached scale factors are invalidated as well."""
+        self.update_scale_cache()
+        self.invalidate_crs_contexts()
+        self.tab_shortcut.setEnabled(True)
+        for signal, slot in (('scaleChanged', self.update_scale_cache),
+                             ('extentsChanged', self.update_scale_cache),
+                             ('destinationCrsChanged', self.update_scale_cache),
+                             ('extentsChanged', self.invalidate_crs_contexts),
+                             ('destinationCrsChanged', self.invalidate_crs_contexts)):
+            self.connections.connect(self.canvas, signal, slot, owner=self)
+
         self.make_cursor(self.brush_shape, self.brush_radius, self.brush_angle)
 
     def deactivate(self):
-        """Reset the rubber band and disable the tab shortcut whenever the tool
-        is deactivated."""
+        """Reset the stroke preview, stop tracking the canvas scale and
+        disable the tab shortcut whenever the tool is deactivated."""
         self.reset()
+        self.outline.hide()
         self.tab_shortcut.setEnabled(False)
+        self.connections.disconnect(owner=self)
         QgsMapTool.deactivate(self)
 
+    def teardown(self):
+        """Remove the canvas items and the shortcut owned by the tool, once it
+        will not be activated again, and drop its signal connections."""
+        self.reset()
+        self.connections.disconnect(owner=self)
+        for item in (self.preview, self.outline):
+            self.canvas.scene().removeItem(item)
+        self.tab_shortcut.setEnabled(False)
+        self.tab_shortcut.setParent(None)
+        self.tab_shortcut.deleteLater()
+
     #------------------------------ UPPDATE STATE -----------------------------
     def make_cursor(self, shape, radius, angle):
-        """Render the cursor based on brush shape and size attributes."""
-        if shape == 'circle':
-            brush_pixmap = QPixmap(':/plugins/brush/resources/redcircle_500x500.png')
-                
-        scaled_pixmap = brush_pixmap.scaled(int(radius*2),int(radius*2))
-        transformation = QTransform().rotate(angle)
-        transformed_pixmap = scaled_pixmap.transformed(transformation)
-        brush_cursor = QCursor(transformed_pixmap)
-        
-        self.canvas.setCursor(brush_cursor)
+        """Show the brush outline based on brush shape and size attributes.
+
+        The outline is drawn as a vector path. Brushes small enough to be a
+        cursor use a rendered cursor, cached by shape, radius and angle rounded
+        to buckets. Larger brushes use a cross cursor and self.outline."""
+        self.outline.set_brush(shape, radius, angle)
+
+        if 2*radius + 4 <= MAX_CURSOR_SIZE:
+            self.outline.hide()
+            step = self.cursor_angle_step
+            cursor = brush_cursor(shape, max(1, round(radius)),
+                                  round(angle / step) * step % 360)
+        else:
+            cursor = QCursor(Qt.CrossCursor)
+            self.outline.show()
+
+        self.canvas.setCursor(cursor)
+
+    def update_scale_cache(self, *args):
+        """Refresh the cached number of map units per pixel from the map
+        canvas. Connected to the canvas signals that can change the scale so
+        that the geometry helpers can read it without copying map settings."""
+        self.map_units_per_pixel = self.canvas.mapSettings().mapUnitsPerPixel()
+        self.scale_cache_refreshes += 1
+
+    def invalidate_crs_contexts(self, *args):
+        """Mark the scale factors cached by every CrsContext as stale. They
+        are resampled over the new extent the next time they are needed."""
+        for context in self.crs_contexts.values():
+            context.invalidate()
+
+    def update_level_of_detail(self):
+        """Derive the number of points used to approximate the brush from its
+        on-screen circumference, so that the approximation never departs from
+        the exact circle by more than brush_tolerance pixels."""
+        self.brush_points = points_for_radius(self.brush_radius,
+                                              self.brush_tolerance) + 1
+
+    def buffer_segments(self):
+        """Return the number of segments per quarter circle matching
+        brush_points, for use with QgsGeometry.buffer."""
+        return max(2, ceil((self.brush_points - 1) / 4))
 
     def switch_brush_shape(self):
-        """Switch the brush to the next possible shape."""
+        """Switch the brush to the next possible shape.
+
+        The shape is locked while a stroke is drawn, since the stroke was set
+        up for either a centreline or swept shapes when it started. A switch
+        requested meanwhile is applied when the stroke is reset."""
+        if self.stroke is not None:
+            self.pending_shape_switches += 1
+            return
+
         new_brush_index = self.brush_shapes.index(self.brush_shape) + 1
         
         if new_brush_index > len(self.brush_shapes) - 1:
@@ -190,21 +395,42 @@ class BrushTool(QgsMapTool):
     def check_coordinate_systems(self):
         """Check that the active layer is in the same CRS as the project 
         instance, and if not, update the reprojection flag and prepare the 
-        necessary transformation."""
+        necessary transformation.
+
+        The transformation is cached per pair of CRS, so switching back and
+        forth between layers does not rebuild it."""
         self.active_layer = self.iface.activeLayer()
+        self.reprojecting = False
+        self.crs_context = None
+        self.t = None
         if self.active_layer != None: 
-            if self.canvas.project().crs().authid() != self.active_layer.sourceCrs().authid():
+            project_crs = self.canvas.project().crs()
+            layer_crs = self.active_layer.sourceCrs()
+            key = (project_crs.authid(), layer_crs.authid())
+            if key[0] != key[1]:
+                if key not in self.crs_contexts:
+                    self.crs_contexts[key] = CrsContext(project_crs, layer_crs)
                 self.reprojecting = True
-                self.t = QgsCoordinateTransform(
-                    self.canvas.project().crs(),
-                    self.active_layer.sourceCrs(),
-                    QgsProject.instance())
+                self.crs_context = self.crs_contexts[key]
+                self.t = self.crs_context.transform
 
     def reset(self):
         """Erase data in geometric attributes when the tool is reset."""
         self.previous_point = None
-        self.previous_geometry = None
-        self.rb.reset(QgsWkbTypes.PolygonGeometry)
+        self.previous_vertices = None
+        self.stroke = None
+        self.coverage = None
+        self.flush_timer.stop()
+        self.projection_timer.stop()
+        self.pending_position = None
+        self.latest_position = None
+        self.recorded_position = None
+        self.preview.reset()
+
+        # Apply the shape switches requested during the stroke
+        switches, self.pending_shape_switches = self.pending_shape_switches, 0
+        for switch in range(switches):
+            self.switch_brush_shape()
 
     #------------------------------- INTERACTION ------------------------------
     def wheelEvent(self, event):
@@ -222,6 +448,7 @@ class BrushTool(QgsMapTool):
             if 5 < self.brush_radius < 1000:
                 d = event.angleDelta().y()
                 self.brush_radius *= 1 + d/1000  #TODO: account for high-dpi mice
+                self.update_level_of_detail()
                 self.make_cursor(self.brush_shape, int(self.brush_radius), int(self.brush_angle))
         
         elif event.modifiers() == (Qt.ControlModifier | Qt.ShiftModifier):
@@ -231,7 +458,7 @@ class BrushTool(QgsMapTool):
             self.make_cursor(self.brush_shape, int(self.brush_radius), int(self.brush_angle))
 
     def canvasPressEvent(self, event):
-        """Create initial rubber band geometry based on current mouse position.
+        """Start recording the stroke at the current mouse position.
 
         Args:
             event: A QEvent representing the user clicking a mouse button on
@@ -247,7 +474,7 @@ class BrushTool(QgsMapTool):
         # Set status and color
         if event.button() == Qt.LeftButton:
             self.drawing_mode = 'drawing'
-            self.rb.setColor(self.draw_color)
+            self.preview.setColor(self.draw_color)
 
             # If user pressed Ctrl, toggle the merging flag
             modifiers = QApplication.keyboardModifiers()
@@ -256,130 +483,213 @@ class BrushTool(QgsMapTool):
         
         elif event.button() == Qt.RightButton:
             self.drawing_mode = 'erasing'
-            self.rb.setColor(self.erase_color)
+            self.preview.setColor(self.erase_color)
         
-        # Create initial geometry
+        # Start recording the stroke, in the layer CRS if reprojecting
         point = self.toMapCoordinates(event.pos())
+        self.stroke_radius = self.brush_radius
+        self.stroke_painted_radius = self.painted_radius()
+        radius = self.stroke_radius * self.map_units_per_pixel
+        tolerance = self.brush_tolerance * self.map_units_per_pixel
+        options = {'tolerance': tolerance}
+        if self.reprojecting:
+            options['project'] = partial(transform_vertices, self.t)
+            options['scale'] = self.crs_context.scale_factor_at(
+                point, self.canvas.extent())
+        if self.stroke_engine == 'raster':
+            cell_size = self.raster_cell_size * self.map_units_per_pixel
+            self.stroke = StrokeMask(radius, cell_size, **options)
+        else:
+            self.stroke = StrokeAccumulator(
+                radius, self.buffer_segments(),
+                vertex_budget=self.vertex_budget, **options)
+
+        # Create initial geometry
+        self.preview.start(point, 2*radius)
         if self.brush_shape == 'circle':
-            self.rb.setToGeometry(self.circle_around_point(point), None) #changed
-        elif self.brush_shape == 'wedge':
-            self.rb.setToGeometry(self.wedge_around_point(point), None)
-        elif self.brush_shape == 'rectangle':
-            self.rb.setToGeometry(self.rectangle_around_point(point), None)
+            initial_vertices = None
+            self.stroke.add_point(point)
+            self.preview.add_point(point)
+        else:
+            initial_vertices = self.vertices_around_point(
+                self.brush_shape, point, self.stroke_radius)
+            self.stroke.add_polygon(initial_vertices)
+            self.preview.add_polygon(initial_vertices)
     
-        # Create previous point and geometry tracker (used in canvasMoveEvent below)
+        # Create previous point and vertices tracker (used in record_move below)
         self.previous_point = point
-        self.previous_geometry = self.rb.asGeometry()
+        self.previous_vertices = initial_vertices
+
+        # Start sampling mouse moves
+        self.sampler.spacing = max(1, self.sample_spacing * self.brush_radius)
+        self.sampler.reset_statistics()
+        self.sampler.start(event.pos().x(), event.pos().y())
+
+        # Start recording the painted area
+        x, y = event.pos().x(), event.pos().y()
+        self.coverage = CoverageGrid(self.stroke_radius / 4)
+        self.coverage.mark(x, y, x, y, self.stroke_painted_radius)
+        self.latest_position = event.pos()
+        self.recorded_position = event.pos()
 
     def canvasMoveEvent(self, event):
-        """Update the rubber band geometry based on mouse movement.
-
-        To keep track of the different geometries used when calculating the 
-        updated geometry of the rubber band, the following variables are used:
-            - previous_geometry: the brush geometry around the previous point
-            - current_geometry: the brush geometry around the current point
-            - new_geometry: the calculated geometry that will be merged with
-                the current rubber band to create the updated rubber band.
-        
+        """Queue mouse moves that are far enough apart to be recorded.
+
+        Moves closer than sampler.spacing pixels to the last accepted move are
+        dropped, and all moves accepted within one frame are coalesced into a
+        single call to record_move by flush_timer.
+
         Args:
             event: A QEvent representing the user moving their mouse across the
                 map canvas.
         """
-        layer = self.active_layer
-
-        if self.drawing_mode in ('drawing','erasing'):
-            # Get current mouse location
-            point = self.toMapCoordinates(event.pos())
-            
-            # Handle drawing with circular brush
+        if self.outline.isVisible():
+            self.outline.set_center(self.toMapCoordinates(event.pos()))
+
+        if self.drawing_mode in ('drawing','erasing') and self.stroke is not None:
+            self.latest_position = event.pos()
+            if self.sampler.accept(event.pos().x(), event.pos().y()):
+                self.pending_position = event.pos()
+                if not self.flush_timer.isActive():
+                    self.flush_timer.start()
+
+    def flush_pending_move(self):
+        """Record the latest mouse move queued by canvasMoveEvent."""
+        if self.pending_position is None or self.stroke is None:
+            return
+        position = self.pending_position
+        self.pending_position = None
+        self.record_move(position)
+
+    def project_pending_samples(self):
+        """Reproject the swept shapes of the stroke recorded since the last
+        batch into the layer CRS, so that little is left to do on release."""
+        if self.stroke is not None:
+            self.stroke.project_pending()
+
+    def record_move(self, position):
+        """Record the stroke and extend the stroke preview at a given mouse
+        position.
+
+        The stroke itself is only unioned once, in canvasReleaseEvent, but the
+        part of it that is no longer changing is simplified as it grows so
+        that it never holds more than vertex_budget vertices. Moves that only
+        sweep over area already painted by the stroke are skipped.
+        Circular strokes only record the centreline, which the preview strokes
+        with a round pen. For all other brushes the following variables are
+        used:
+            - previous_vertices: the brush vertices around the previous point
+            - current_vertices: the brush vertices around the current point
+            - new_vertices: the hull of the area swept by the brush since the
+                previous point, which is recorded and added to the stroke
+                preview. Both brush shapes are convex, so the hull is computed
+                directly from the vertex arrays without GEOS.
+        
+        Args:
+            position: A QPoint indicating the mouse position on the map canvas.
+        """
+        # Get current mouse location
+        point = self.toMapCoordinates(position)
+        segment = (self.recorded_position.x(), self.recorded_position.y(),
+                   position.x(), position.y())
+        self.recorded_position = position
+        self.sampler.keep()
+
+        # Skip the move if the area it sweeps is already painted
+        if self.coverage.covers(*segment, self.stroke_radius):
+            self.coverage_skips += 1
             if self.brush_shape == 'circle':
-                # Calculate line from previous mouse location
-                mouse_move_line = QgsLineString([self.previous_point, point])
-
-                # Calculate buffer distance (could be moved to canvasPressEvent)
-                # scale factor is px / mm; as mm (converted to map pixels, then to map units)
-                context = QgsRenderContext().fromMapSettings(self.canvas.mapSettings())
-                radius = self.brush_radius
-                radius *= context.mapToPixel().mapUnitsPerPixel()
-
-                # Calculate new geometry
-                new_geometry = QgsGeometry(mouse_move_line).buffer(radius, self.brush_points)
-
-                # Set point tracker to current point
+                self.stroke.skip_to(point)
+                self.preview.move_to(point)
                 self.previous_point = point
-
-            # Handle drawing with all other brushes
             else:
-                # Calculate new geometry
-                if self.brush_shape == 'wedge':
-                    current_geometry = self.wedge_around_point(point)
-                elif self.brush_shape == 'rectangle':
-                    current_geometry = self.rectangle_around_point(point)
-                new_geometry = current_geometry.combine(self.previous_geometry).convexHull()
+                self.previous_vertices = self.vertices_around_point(
+                    self.brush_shape, point, self.stroke_radius)
+            return
+        self.coverage.mark(*segment, self.stroke_painted_radius)
+        
+        # Handle drawing with circular brush
+        if self.brush_shape == 'circle':
+            # Record the centreline and set point tracker to current point
+            self.stroke.add_point(point)
+            self.preview.add_point(point)
+            self.previous_point = point
+
+        # Handle drawing with all other brushes
+        else:
+            # Calculate swept area
+            current_vertices = self.vertices_around_point(
+                self.brush_shape, point, self.stroke_radius)
+            new_vertices = swept_hull(self.previous_vertices, current_vertices)
+            self.stroke.add_polygon(new_vertices)
+            self.preview.add_polygon(new_vertices)
+
+            # Set vertices tracker to current vertices
+            self.previous_vertices = current_vertices
 
-                # Set geometry tracker to current geometry
-                self.previous_geometry = current_geometry
+        # Simplify the settled part of the stroke and redraw the preview
+        if self.stroke.settle():
+            self.preview.rebuild(self.stroke.runs, self.stroke.settled_rings(),
+                                 self.stroke.polygons)
 
-            # Set new rubberband geometry
-            self.rb.setToGeometry(self.rb.asGeometry().combine(new_geometry))
+        # Reproject the new samples in the next batch
+        if self.reprojecting and not self.projection_timer.isActive():
+            self.projection_timer.start()
 
     def canvasReleaseEvent(self, event):
-        """Process the rubber band geometry (simplify, reproject if necessary)
-        and then emit it for drawing into the active layer.
+        """Build the stroke geometry in a single pass, process it (simplify,
+        reproject if necessary) and then emit it for drawing into the active
+        layer.
 
         Args:
             event: A QEvent representing the user releasing their mouse button
                 after clicking on the map canvas.
         """
-        current_geometry = self.rb.asGeometry()
-
-        # Reproject the rubberband geometry if necessary
-        if self.reprojecting == True:
-            new_geometry = QgsGeometry(current_geometry) #have to clone before transforming
-            new_geometry.transform(self.t)
-        else:
-            new_geometry = current_geometry
-
-        # Simplify the rubberband geometry
-        # tolerance value is calculated based on brush_radius and brush_points
-        # Calculate tolerance in layer CRS units to ensure consistent simplification
-        context = QgsRenderContext().fromMapSettings(self.canvas.mapSettings())
-        radius = self.brush_radius
-        radius *= context.mapToPixel().mapUnitsPerPixel()
-
-        # If reprojecting, transform the tolerance to layer CRS
-        if self.reprojecting:
-            # Create a small geometry in map CRS to determine scale factor
-            map_center = self.canvas.extent().center()
-            map_radius_geom = self.circle_around_point(map_center, radius, 8, map_units=True)
-            
-            # Transform to layer CRS and measure
-            layer_radius_geom = QgsGeometry(map_radius_geom)
-            layer_radius_geom.transform(self.t)
-            
-            # Calculate scale factor between map and layer CRS
-            map_area = map_radius_geom.area()
-            layer_area = layer_radius_geom.area()
-            if map_area > 0:
-                scale_factor = (layer_area / map_area) ** 0.5
-                radius *= scale_factor
-
-        tolerance = (2*pi*radius)/(24*self.brush_points)
+        if self.stroke is None:
+            return
+
+        # Record the final mouse position, even if it was dropped or is
+        # still waiting for the flush timer
+        self.flush_timer.stop()
+        self.pending_position = None
+        self.latest_position = event.pos()
+        if self.latest_position != self.recorded_position:
+            self.record_move(self.latest_position)
+
+        # Build the stroke geometry; if reprojecting, the swept shapes have
+        # been reprojected while drawing, the buffered centreline is
+        # reprojected now, and the geometry is in layer CRS
+        self.projection_timer.stop()
+        new_geometry = self.stroke.geometry()
+
+        # Simplify the stroke geometry
+        # tolerance value is the on-screen error bound of the brush, in map
+        # units; only the settled part of the stroke may have been coarsened
+        # to keep within the vertex budget
+        tolerance = self.stroke.tolerance
+
+        # If reprojecting, scale the tolerance to layer CRS using the cached
+        # scale factor between map and layer CRS around the stroke
+        tolerance *= self.stroke.scale
 
         new_geometry = new_geometry.simplify(tolerance)
         
         # Emit final geometry
         self.rb_finished.emit(new_geometry)
-
-        # refresh the canvas and reset the rubberband and flags
+        # reset the stroke preview and flags; the target layer is repainted
+        # by whoever handles the emitted geometry
         self.reset()
-        self.canvas.refresh()
 
         self.drawing_mode = 'inactive'
 
         self.merging = False
     
     #------------------------------- CALCULATION ------------------------------
+    def painted_radius(self):
+        """Return the radius in pixels of the largest circle centered on the
+        brush that is always painted by the current brush shape."""
+        return self.brush_radius * inner_radius(self.brush_shape, self.brush_points)
+
     def circle_around_point(self, center, radius=0, num_points=0, map_units=False):
         """Create a circular QgsGeometry centered on a point with a given 
         radius approximated by a number of points.
@@ -401,22 +711,92 @@ class BrushTool(QgsMapTool):
         References:
             - Adapted from https://gis.stackexchange.com/a/69792
         """
+        return self.shape_around_point('circle', center, radius, num_points,
+                                       map_units, angle=0)
+
+    def wedge_around_point(self, center, radius=0, map_units=False):
+        """Create a wedge-shaped QgsGeometry centered on a point, pointing in
+        the direction of the brush angle.
+
+        Args:
+            center: A QgsPointXY indicating the center of the wedge.
+            radius: An integer or float representing the distance from the
+                center to the corners of the wedge. Defaults to 0, which means
+                that self.brush_radius is used.
+            map_units: A boolean indicating whether the radius should be
+                considered to be in map units. Defaults to False, which means
+                that radius is converted from pixels to map units.
+
+        Returns:
+            A QgsGeometry (of type QGis.Polygon) of the wedge.
+        """
+        return self.shape_around_point('wedge', center, radius, 0, map_units)
+
+    def rectangle_around_point(self, center, radius=0, map_units=False):
+        """Create a rectangular QgsGeometry centered on a point, rotated by
+        the brush angle.
+
+        Args:
+            center: A QgsPointXY indicating the center of the rectangle.
+            radius: An integer or float representing the distance from the
+                center to the corners of the rectangle. Defaults to 0, which
+                means that self.brush_radius is used.
+            map_units: A boolean indicating whether the radius should be
+                considered to be in map units. Defaults to False, which means
+                that radius is converted from pixels to map units.
+
+        Returns:
+            A QgsGeometry (of type QGis.Polygon) of the rectangle.
+        """
+        return self.shape_around_point('rectangle', center, radius, 0,
+                                       map_units)
+
+    def shape_around_point(self, shape, center, radius=0, num_points=0,
+                           map_units=False, angle=None):
+        """Create a QgsGeometry of a brush shape centered on a point.
+
+        The unit vertices of every shape are computed once (see
+        strokes.shape_template), so each call only scales, rotates and
+        translates a small array and builds the geometry from WKB.
+
+        Args:
+            shape: A string of the name of the brush shape.
+            center: A QgsPointXY indicating the center of the shape.
+            radius: An integer or float representing the radius of the shape.
+                Defaults to 0, which means that self.brush_radius is used.
+            num_points: An integer indicating the number of points to use when
+                approximating a circle. Defaults to 0, which means that
+                self.brush_points is used.
+            map_units: A boolean indicating whether the radius should be
+                considered to be in map units. Defaults to False, which means
+                that radius is converted from pixels to map units.
+            angle: A float representing the angle of the shape in degrees.
+                Defaults to None, which means that self.brush_angle is used.
+
+        Returns:
+            A QgsGeometry (of type QGis.Polygon) of the shape.
+        """
+        vertices = self.vertices_around_point(shape, center, radius,
+                                              num_points, map_units, angle)
+        return polygon_from_vertices(vertices)
+
+    def vertices_around_point(self, shape, center, radius=0, num_points=0,
+                              map_units=False, angle=None):
+        """Calculate the vertices of a brush shape centered on a point.
+
+        Takes the same arguments as shape_around_point.
+
+        Returns:
+            A numpy array of shape (n, 2) containing the vertices of the
+            exterior ring of the shape (without the closing vertex).
+        """
         if not radius:
             radius = self.brush_radius #default brush radius
-        
         if not map_units:
-            context = QgsRenderContext().fromMapSettings(self.canvas.mapSettings())
-            # scale factor is px / mm; as mm (converted to map pixels, then to map units)
-            radius *= context.mapToPixel().mapUnitsPerPixel()
+            radius *= self.map_units_per_pixel
         if not num_points:
             num_points = self.brush_points
+        if angle is None:
+            angle = self.brush_angle
 
-        points = []
-
-        for i in range(num_points-1):
-            theta = i * (2.0 * pi / (num_points-1))
-            p = QgsPointXY(center.x() + radius * cos(theta),
-                         center.y() + radius * sin(theta))
-            points.append(p)
-        
-        return QgsGeometry.fromPolygonXY([points])
+        return stamp_vertices(shape, num_points, center, radius, angle)
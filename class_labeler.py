@@ -1,7 +1,7 @@
 from qgis.PyQt.QtWidgets import (QAction, QWidget, QVBoxLayout, QHBoxLayout, 
                                   QPushButton, QLineEdit, QLabel, QListWidget, 
                                   QListWidgetItem, QComboBox, QMessageBox, QToolButton,
-                                  QSizePolicy, QFrame)
+                                  QSizePolicy, QFrame, QCheckBox)
 from qgis.PyQt.QtCore import Qt, pyqtSignal
 from qgis.PyQt.QtGui import QIcon, QKeySequence
 from qgis.core import (QgsProject, QgsDefaultValue, QgsSettings, QgsVectorLayer, 
@@ -9,15 +9,15 @@ from qgis.core import (QgsProject, QgsDefaultValue, QgsSettings, QgsVectorLayer,
 from qgis.gui import QgsMapLayerComboBox, QgsDockWidget
 from qgis.utils import iface
 import os
+from importlib import import_module
+from importlib.util import find_spec
 
-# Import brush tool classes
-try:
-    from .drawmybrush import DrawByBrush
-    BRUSH_AVAILABLE = True
-    
-except ImportError as e:
-    BRUSH_AVAILABLE = False
-    
+from .connections import ConnectionRegistry
+
+# Check that the brush tool can be loaded, without importing it. The brush
+# subsystem is only imported when the brush tool is first activated.
+BRUSH_AVAILABLE = (find_spec('.drawmybrush', __package__) is not None and
+                   find_spec('numpy') is not None)
 
 
 class ClassLabelerPlugin:
@@ -30,6 +30,9 @@ class ClassLabelerPlugin:
         self.dock_widget = None
         self.current_layer = None
         self.brush_tool = None
+        self.brush_class_scoped = False
+        self.brush_paint_mode = 'overlap'
+        self.connections = ConnectionRegistry()
 
         # self.iface.messageBar().pushWarning("Class Labeler", f"{BRUSH_AVAILABLE=}")
         
@@ -73,6 +76,11 @@ class ClassLabelerPlugin:
         except:
             pass
         self.cleanup_toolbar()
+        # Clean up brush tool properly
+        if self.brush_tool:
+            self.brush_tool.unload()
+            self.brush_tool = None
+        self.connections.disconnect()
         if hasattr(self, 'action') and self.action:
             self.iface.removeToolBarIcon(self.action)
         if self.dock_widget:
@@ -84,10 +92,6 @@ class ClassLabelerPlugin:
             self.toolbar = None
         if hasattr(self, 'actions'):
             self.actions = []
-        # Clean up brush tool properly
-        if hasattr(self, 'brush_tool') and self.brush_tool:
-            self.brush_tool.unload()
-            self.brush_tool = None
             
     def show_dock(self, checked=False):
         """Toggle the dock widget visibility.
@@ -134,16 +138,49 @@ class ClassLabelerPlugin:
             self.actions.append(action)
             
         self.update_active_button()
-        
-        # Initialize brush tool with class labeler integration
-        if BRUSH_AVAILABLE:
-            self.brush_tool = DrawByBrush(
+
+    def get_brush_tool(self):
+        """Return the brush tool, importing and creating it on first use.
+
+        Returns:
+            The DrawByBrush instance, or None if the brush subsystem cannot
+            be imported.
+        """
+        if self.brush_tool is None and BRUSH_AVAILABLE:
+            try:
+                drawmybrush = import_module('.drawmybrush', __package__)
+            except ImportError as e:
+                self.iface.messageBar().pushCritical(
+                    "Class Labeler", f"Brush tool could not be loaded: {e}")
+                return None
+            self.brush_tool = drawmybrush.DrawByBrush(
                 self.iface,
                 class_value_getter=self.current_class_value,
-                class_field_getter=self.current_class_field
+                class_field_getter=self.current_class_field,
+                connections=self.connections
             )
             self.brush_tool.initGui()
+            self.brush_tool.class_scoped = self.brush_class_scoped
+            self.brush_tool.paint_mode = self.brush_paint_mode
+            # The active layer was set before the brush hooked its signals
+            self.brush_tool.get_active_layer()
+            self.brush_tool.brush_action_requirements_check()
+        return self.brush_tool
             
+    def set_brush_class_scoped(self, checked):
+        """Limit brush merging and erasing to the features of the active
+        class, or not."""
+        self.brush_class_scoped = bool(checked)
+        if self.brush_tool:
+            self.brush_tool.class_scoped = self.brush_class_scoped
+
+    def set_brush_paint_mode(self, mode):
+        """Set how new brush strokes treat the features they overlap:
+        'overlap', 'replace' or 'fill'."""
+        self.brush_paint_mode = mode
+        if self.brush_tool:
+            self.brush_tool.paint_mode = self.brush_paint_mode
+
     def set_default_class_by_index(self, index):
         if 0 <= index < len(self.classes):
             self.active_class_index = index
@@ -186,14 +223,12 @@ class ClassLabelerPlugin:
 
     def set_target_layer(self, layer):
         if getattr(self, "current_layer", None):
-            try:
-                self.current_layer.willBeDeleted.disconnect(self.on_current_layer_deleted)
-            except Exception:
-                pass
+            self.connections.disconnect(owner=self, sender=self.current_layer)
 
         self.current_layer = layer
         if layer:
-            layer.willBeDeleted.connect(self.on_current_layer_deleted)
+            self.connections.connect(layer, 'willBeDeleted',
+                                     self.on_current_layer_deleted, owner=self)
 
     def on_current_layer_deleted(self):
         self.cleanup_toolbar()
@@ -323,6 +358,31 @@ class ClassLabelerDockWidget(QgsDockWidget):
             self.brush_btn.setEnabled(False)  # Disabled until toolbar is created
             brush_layout.addWidget(self.brush_btn)
             layout.addLayout(brush_layout)
+
+            self.class_scope_check = QCheckBox("Merge/erase active class only")
+            self.class_scope_check.setToolTip(
+                "Only merge with or erase features whose class is the active class")
+            self.class_scope_check.setChecked(self.plugin.brush_class_scoped)
+            self.class_scope_check.toggled.connect(self.plugin.set_brush_class_scoped)
+            layout.addWidget(self.class_scope_check)
+
+            paint_layout = QHBoxLayout()
+            paint_layout.addWidget(QLabel("New strokes:"))
+            self.paint_mode_combo = QComboBox()
+            self.paint_mode_combo.addItem("Overlap existing", 'overlap')
+            self.paint_mode_combo.addItem("Replace existing", 'replace')
+            self.paint_mode_combo.addItem("Fill gaps only", 'fill')
+            self.paint_mode_combo.setToolTip(
+                "Replace and fill keep the layer free of overlaps: a stroke is "
+                "erased from the features of every class, or clipped to the "
+                "area they leave uncovered")
+            self.paint_mode_combo.setCurrentIndex(
+                self.paint_mode_combo.findData(self.plugin.brush_paint_mode))
+            self.paint_mode_combo.currentIndexChanged.connect(
+                lambda index: self.plugin.set_brush_paint_mode(
+                    self.paint_mode_combo.itemData(index)))
+            paint_layout.addWidget(self.paint_mode_combo)
+            layout.addLayout(paint_layout)
         
         layout.addStretch()
         widget.setLayout(layout)
@@ -332,9 +392,12 @@ class ClassLabelerDockWidget(QgsDockWidget):
         
     def activate_brush_tool(self):
         """Activate the brush tool with class labeler integration."""
-        if hasattr(self.plugin, 'brush_tool') and self.plugin.brush_tool:
+        brush_tool = None
+        if getattr(self.plugin, 'toolbar', None):
+            brush_tool = self.plugin.get_brush_tool()
+        if brush_tool:
             # Activate the brush tool
-            self.plugin.brush_tool.activate_brush_tool()
+            brush_tool.activate_brush_tool()
         else:
             QMessageBox.warning(self, "Warning", "Brush tool not available. Create toolbar first.")
         
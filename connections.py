@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Signal connection bookkeeping for Class Labeler.
+
+Qt happily connects the same slot to the same signal many times, and every
+duplicate runs on each emission. The registry here makes connecting
+idempotent and remembers who made each connection, so that everything an
+object connected can be disconnected in one call when a layer changes, a
+tool is torn down or the plugin is unloaded.
+"""
+
+
+class ConnectionRegistry:
+    """Idempotent, ownership-tracked signal connections.
+
+    Attributes:
+        connections: A dict mapping (sender id, signal name, slot) to the
+            (sender, signal name, slot, owner) of each live connection.
+
+    Methods:
+        connect: Connect a signal to a slot, unless already connected.
+        disconnect: Disconnect the connections of an owner and/or sender.
+        count: Count the live connections of an owner.
+    """
+
+    def __init__(self):
+        """Constructor for the connection registry."""
+        self.connections = {}
+
+    def connect(self, sender, signal, slot, owner=None):
+        """Connect a signal to a slot, unless they are already connected.
+
+        Args:
+            sender: The QObject emitting the signal.
+            signal: A string of the name of the signal.
+            slot: The callable to connect. Bound methods compare equal when
+                they wrap the same function and object, so they are only
+                connected once; lambdas are new objects every time.
+            owner: The object responsible for the connection, used to
+                disconnect it later. Defaults to None.
+
+        Returns:
+            True if a new connection was made, False if it already existed.
+        """
+        key = (id(sender), signal, slot)
+        if key in self.connections:
+            return False
+        getattr(sender, signal).connect(slot)
+        self.connections[key] = (sender, signal, slot, owner)
+        return True
+
+    def disconnect(self, owner=None, sender=None):
+        """Disconnect every connection matching an owner and/or a sender.
+
+        Connections whose sender has already been deleted are dropped
+        silently.
+
+        Args:
+            owner: If given, only disconnect the connections of this owner.
+            sender: If given, only disconnect the connections from this
+                sender.
+
+        Returns:
+            An integer number of connections removed.
+        """
+        removed = 0
+        for key, (s, signal, slot, o) in list(self.connections.items()):
+            if owner is not None and o is not owner:
+                continue
+            if sender is not None and s is not sender:
+                continue
+            try:
+                getattr(s, signal).disconnect(slot)
+            except (TypeError, RuntimeError):
+                pass
+            del self.connections[key]
+            removed += 1
+        return removed
+
+    def count(self, owner=None):
+        """Return the number of live connections, of an owner if given."""
+        if owner is None:
+            return len(self.connections)
+        return sum(1 for s, signal, slot, o in self.connections.values()
+                   if o is owner)
@@ -43,23 +43,74 @@ from qgis.PyQt.QtWidgets import QAction
 
 # Import necessary QGIS classes
 from qgis.core import QgsFeature, QgsProject, QgsGeometry, QgsVectorLayer,\
-    QgsRenderContext, QgsLayerTreeGroup, QgsWkbTypes, QgsMapLayer, QgsExpressionContextUtils
+    QgsRenderContext, QgsLayerTreeGroup, QgsWkbTypes, QgsMapLayer, QgsExpressionContextUtils, \
+    QgsFeatureRequest, QgsSimplifyMethod, QgsRectangle, QgsExpression, \
+    QgsExpressionContext
 
-# Initialize Qt resources from file resources.py
-from .resources import *
+# Qt resources are registered on first use, see lazyresources.py
+from .lazyresources import load_resources
 
 # Import the code for the DockWidget
 import os.path
+from collections import OrderedDict
 
 # Import the brush tool code
 from .brushtools import BrushTool
+from .connections import ConnectionRegistry
+from .layerindex import LayerIndex
+
+def relation_from_matrix(matrix):
+    """Classify the relation between two polygons from their DE-9IM
+    intersection matrix.
+
+    Args:
+        matrix: A string of the nine characters of the DE-9IM matrix of the
+            stroke (first geometry) against a feature (second geometry).
+
+    Returns:
+        'contains' if the stroke contains the feature (including when both
+        are equal), 'contained_by' if the stroke lies within the feature,
+        'partial_overlap' if their interiors only partly overlap, or None if
+        their interiors do not intersect.
+    """
+    if len(matrix) != 9 or matrix[0] == 'F':
+        return None
+    if matrix[6] == 'F' and matrix[7] == 'F':
+        return 'contains'
+    if matrix[2] == 'F' and matrix[5] == 'F':
+        return 'contained_by'
+    if matrix[2] != 'F' and matrix[6] != 'F':
+        return 'partial_overlap'
+    return None
+
 
 class DrawByBrush:
     """QGIS Plugin Implementation of Draw by Brush.
     
     Attributes:
         iface: The QgsInterface of the current project instance.
-        tool: The BrushTool or other currently active plugin map tool.
+        tool: The BrushTool of the plugin, created on first activation and
+            re-armed on every later activation, or None.
+        activations: An integer counting how many times the brush tool was
+            activated.
+        connections: The ConnectionRegistry through which the plugin, its
+            tool and the hooks on the active layer are connected.
+        hooked_layer: The layer whose editing signals are currently
+            connected to brush_action_requirements_check, or None.
+        layer_indexes: An OrderedDict mapping layer ids to the LayerIndex of
+            the polygon layers most recently drawn into, oldest first.
+        max_layer_indexes: An integer number of layer indexes kept; the least
+            recently used one is released beyond it.
+        dirty_extent: The QgsRectangle of self.active_layer changed by the
+            last stroke, or None if it changed nothing.
+        class_scoped: A boolean indicating whether merging and erasing only
+            act on the features of the current class.
+        paint_mode: A string of how a new stroke treats the features it
+            overlaps: 'overlap' leaves them as they are, 'replace' erases the
+            stroke from them and 'fill' clips the stroke to the area they
+            leave uncovered. The last two keep the layer free of overlaps,
+            whatever the class of the features, and also apply to the
+            result of a merge.
         previous_tool: The QgsMapTool that was active when the plugin was first
             activated.
         active_layer: The currently active map layer (can be any subclass of
@@ -85,6 +136,8 @@ class DrawByBrush:
         initGui: Create the menu entries and toolbar icons inside the QGIS GUI.
         tr: Translate a string using Qt translation API.
         activate_brush_tool: Activate the brush tool.
+        object_counts: Count the objects that could pile up across
+            activations.
         onClosePlugin: Clean up necessary items when dockwidget is closed.
         unload: Clean up necessary items when the plugin is unloaded.
         add_action: Add a button bound to an action onto the plugin toolbar.
@@ -94,18 +147,29 @@ class DrawByBrush:
             action activation are met, and disable the action if not.
         draw: Take the geometry and drawing flags from self.tool and modify
             self.active_layer accordingly.
+        erased_geometries: Compute the geometries left of the features
+            overlapping a stroke once the stroke is erased from them.
+        mark_dirty: Grow the extent changed by the current stroke.
+        dirty_extent_visible: Check whether the extent changed by the current
+            stroke is visible on the map canvas.
         set_previous_tool: Reset self.previous_tool to the currently active
             map tool.
         features_overlapping_with: Determine which features in self.active_layer
             overlap with a given feature, and organize them into a dict
             by type of overlap.
         get_active_layer: Reset the reference to the currently active layer and
-             reconnect editing signals with brush_action_requirements_check
-             accordingly.
+             move the editing signal hooks from the previous layer to it.
+        release_layer_indexes: Release all the spatial indexes.
+        layer_index: Return the LayerIndex of a layer, creating it if needed.
+        overlap_request: Build the request fetching the features that may
+            overlap a bounding box.
+        class_filter: Build the expression selecting the features of the
+            current class, for class-scoped merging and erasing.
     """
 
     #------------------------------ INITIALIZATION ----------------------------
-    def __init__(self, iface, class_value_getter=None, class_field_getter=None):
+    def __init__(self, iface, class_value_getter=None, class_field_getter=None,
+                 connections=None):
         """Constructor for the Draw by Brush plugin.
 
         Args:
@@ -113,6 +177,8 @@ class DrawByBrush:
                 class can manipulate the QGIS application at run time.
             class_value_getter: Optional callable that returns current class value
             class_field_getter: Optional callable that returns current class field name
+            connections: Optional ConnectionRegistry shared with the host
+                plugin. Defaults to None, which creates a new one.
         """
         # Save reference to the QGIS interface
         self.iface = iface
@@ -126,6 +192,14 @@ class DrawByBrush:
 
         # Save additional references
         self.tool = None
+        self.activations = 0
+        self.connections = connections or ConnectionRegistry()
+        self.hooked_layer = None
+        self.layer_indexes = OrderedDict()
+        self.max_layer_indexes = 4
+        self.dirty_extent = None
+        self.class_scoped = False
+        self.paint_mode = 'overlap'
         self.previous_tool = None
         self.active_layer = None
 
@@ -187,13 +261,15 @@ class DrawByBrush:
         
         # Connect necessary signals and slots
         # Get necessary info whenever active layer changes
-        self.iface.currentLayerChanged.connect(self.get_active_layer)
+        self.connections.connect(self.iface, 'currentLayerChanged',
+                                 self.get_active_layer, owner=self)
 
         # Save reference to previous map tool whenever brush action is activated -- TODO: check that toggled is the correct signal here
         self.brush_action.toggled.connect(lambda x: self.set_previous_tool(self.brush_action))
 
         # Only enable brush action if a Polygon or MultiPolygon Vector layer is selected
-        self.iface.currentLayerChanged.connect(self.brush_action_requirements_check)
+        self.connections.connect(self.iface, 'currentLayerChanged',
+                                 self.brush_action_requirements_check, owner=self)
 
     #------------------------------ COMMUNICATION -----------------------------
     def tr(self, message):
@@ -210,15 +286,22 @@ class DrawByBrush:
     #------------------------------- ACTIVATION -------------------------------
     def activate_brush_tool(self):
         """Set up the brush tool, connect it to the GUI, and connect its 
-        signals with the proper slots."""
+        signals with the proper slots.
+
+        The tool is only created on the first activation. Later activations
+        re-arm the same tool, so that its canvas items, shortcut and signal
+        connections are not duplicated."""
         # Load and start the plugin
         if not self.pluginIsActive:
             self.pluginIsActive = True
+        self.activations += 1
 
         # Initialize and configure self.tool
-        self.tool = BrushTool(self.iface)
-        self.tool.setAction(self.actions[0])
-        self.tool.rb_finished.connect(lambda g: self.draw(g))
+        if self.tool is None:
+            self.tool = BrushTool(self.iface, self.connections)
+            self.tool.setAction(self.actions[0])
+            self.connections.connect(self.tool, 'rb_finished', self.draw,
+                                     owner=self)
         
         # Select the tool in the current interface
         self.iface.mapCanvas().setMapTool(self.tool)
@@ -229,6 +312,24 @@ class DrawByBrush:
         # Show controls in the status bar
         self.sb.showMessage(self.status_tip)
 
+    def object_counts(self):
+        """Count the objects that could pile up across activations, to check
+        that memory stays flat when the tool is toggled.
+
+        Returns:
+            A dict with the number of BrushTool instances alive, the number of
+            items on the map canvas, the number of children of the main
+            window (which owns the tool shortcuts), the number of
+            activations so far and the number of live signal connections.
+        """
+        return {
+            'brush_tools': len(BrushTool.instances),
+            'canvas_items': len(self.iface.mapCanvas().scene().items()),
+            'main_window_children': len(self.iface.mainWindow().children()),
+            'activations': self.activations,
+            'connections': self.connections.count(),
+        }
+
     def onClosePlugin(self):
         """Cleanup necessary items here when plugin dockwidget is closed"""
         self.pluginIsActive = False
@@ -242,6 +343,20 @@ class DrawByBrush:
             self.iface.removeToolBarIcon(action)
         # No toolbar to remove since we don't create one
 
+        # Drop the hooks on the interface and the active layer
+        self.connections.disconnect(owner=self)
+        self.hooked_layer = None
+
+        # Drop the spatial indexes
+        self.release_layer_indexes()
+
+        # Release the brush tool along with its canvas items and shortcut
+        if self.tool is not None:
+            if self.iface.mapCanvas().mapTool() == self.tool:
+                self.iface.mapCanvas().unsetMapTool(self.tool)
+            self.tool.teardown()
+            self.tool = None
+
     #------------------------------ UPPDATE STATE -----------------------------
     def add_action(
         self,
@@ -278,6 +393,8 @@ class DrawByBrush:
             The QAction that was created. Note that the action is also added to
             self.actions.
         """
+        if icon_path.startswith(':/'):
+            load_resources()
         icon = QIcon(icon_path)
         action = QAction(icon, text, parent)
         action.triggered.connect(callback)
@@ -333,6 +450,7 @@ class DrawByBrush:
         modify self.active_layer accordingly."""
         # Get current active layer used in the drawing tool
         self.active_layer = self.tool.active_layer
+        self.dirty_extent = None
 
         # Require layer to already be in edit mode
         if not self.active_layer.isEditable():
@@ -363,79 +481,77 @@ class DrawByBrush:
             # all overlapping features
             # TODO: if attributes are present, prompt user to select which
             #       overlapping feature to take attribute data from
+            merged_ids = []
+            removed_ids = []
+            new_geometries = {}
             if self.tool.merging:
                 overlapping_features = self.features_overlapping_with(new_feature)    
-                for f in overlapping_features['any_overlap']:
-                    new_feature.setGeometry(new_feature.geometry().combine(f.geometry()))
-                    self.active_layer.deleteFeature(f.id())
-            
+                merged_ids = overlapping_features['any_overlap']
+                if merged_ids:
+                    # Union the stroke and all overlapping features at once
+                    geometries = overlapping_features['geometry']
+                    new_feature.setGeometry(QgsGeometry.unaryUnion(
+                        [new_feature.geometry()] +
+                        [geometries[fid] for fid in merged_ids]))
+
+            # In the coverage modes, keep the layer free of overlaps by
+            # erasing the stroke (merged or not) from the features of every
+            # class, or by clipping it to the area they leave uncovered
+            if self.paint_mode in ('replace', 'fill'):
+                overlapping_features = self.features_overlapping_with(
+                    new_feature, scoped=False, exclude=merged_ids)
+                geometries = overlapping_features['geometry']
+                if self.paint_mode == 'replace':
+                    new_geometries = self.erased_geometries(
+                        new_feature.geometry(), overlapping_features)
+                    removed_ids = overlapping_features['contains']
+                    for fid in list(new_geometries) + removed_ids:
+                        self.mark_dirty(geometries[fid].boundingBox())
+                elif overlapping_features['any_overlap']:
+                    covered = QgsGeometry.unaryUnion(
+                        [geometries[fid] for fid in overlapping_features['any_overlap']])
+                    new_feature.setGeometry(new_feature.geometry().difference(covered))
+                    if new_feature.geometry().isEmpty():
+                        # Nothing left to paint
+                        self.tool.reset()
+                        return
+
             # Wrap in edit command for proper undo/redo support
             self.active_layer.beginEditCommand("Brush add")
+            for fid, new_geometry in new_geometries.items():
+                self.active_layer.changeGeometry(fid, new_geometry)
+            if merged_ids or removed_ids:
+                self.active_layer.deleteFeatures(merged_ids + removed_ids)
             ok = self.active_layer.addFeature(new_feature)
             if not ok:
                 self.active_layer.destroyEditCommand()
                 self.iface.messageBar().pushCritical("Brush", f"Add failed: {self.active_layer.lastError()}")
                 return
             self.active_layer.endEditCommand()
+            self.mark_dirty(new_feature.geometry().boundingBox())
 
         # If erasing, modify existing features
         elif self.tool.drawing_mode == 'erasing':
             # Calculate overlapping features
             overlapping_features = self.features_overlapping_with(new_feature)
-            
-            # Cut a hole through all features that new_feature is contained by
-            contained_by_features = overlapping_features['contained_by']
-            for f in contained_by_features:
-                # Get current and previous geometries
-                current_geometry = new_feature.geometry()
-                current_geometry.convertToMultiType() #sometimes there is only one part
-                current_polygon = current_geometry.asMultiPolygon()[0]
-                current_exterior = current_polygon[0]
-                current_holes = current_polygon[1:] 
-                
-                previous_geometry = f.geometry()
-                previous_geometry.convertToMultiType() #sometimes previous feature is not multitype
-                previous_polygon = previous_geometry.asMultiPolygon()[0]
-                previous_exterior = previous_polygon[0]
-                previous_holes = previous_polygon[1:]
-
-                # Calculate new holes
-                previous_holes_geometry = QgsGeometry().fromMultiPolygonXY([previous_holes])
-                new_holes_geometry = QgsGeometry().fromMultiPolygonXY([[current_exterior]])
-                new_holes_geometry.combine(previous_holes_geometry)
-                new_holes = new_holes_geometry.asMultiPolygon()
-
-                # Calculate new island parts, if any
-                if current_holes != []:
-                    print(current_holes)
-                    current_holes_geometry = QgsGeometry().fromMultiPolygonXY([current_holes])
-                    new_parts_geometry = current_holes_geometry.intersection(previous_geometry)
-                    new_parts_geometry.convertToMultiType()  #sometimes there is only one part
-                    new_parts = new_parts_geometry.asMultiPolygon()
-
-                # Add calculated holes and parts
-                new_geometry = QgsGeometry(previous_geometry)   # copy the previous geometry
-                for hole in new_holes:
-                    new_geometry.addRing(hole[0])
-                if current_holes != []:
-                    for part in new_parts_geometry.constParts():
-                        new_geometry.addPart(part.boundary())
-                
-                # Change feature geometry to what was calculated above
-                f.setGeometry(new_geometry)
-                self.active_layer.updateFeature(f)
-
-            # Delete all features that new_feature contains
-            contains_features = overlapping_features['contains']
-            for f in contains_features:
-                self.active_layer.deleteFeature(f.id())
+            geometries = overlapping_features['geometry']
 
-            # For all other features, modify their geometry
-            for f in overlapping_features['partial_overlap']:
-                previous_geometry = f.geometry()
-                new_geometry = previous_geometry.difference(new_feature.geometry())
-                f.setGeometry(new_geometry)
-                self.active_layer.updateFeature(f)
+            # Compute every new geometry first, then apply them all at once
+            new_geometries = self.erased_geometries(new_feature.geometry(),
+                                                    overlapping_features)
+
+            # Apply the changes and delete all features that new_feature
+            # contains, as a single undo step
+            contains_features = overlapping_features['contains']
+            if new_geometries or contains_features:
+                self.active_layer.beginEditCommand("Brush erase")
+                for fid, new_geometry in new_geometries.items():
+                    self.active_layer.changeGeometry(fid, new_geometry)
+                if contains_features:
+                    self.active_layer.deleteFeatures(contains_features)
+                self.active_layer.endEditCommand()
+                for fid in list(new_geometries) + contains_features:
+                    self.mark_dirty(geometries[fid].boundingBox())
 
             #self.active_layer.commitChanges(stopEditing=False)
 
@@ -443,13 +559,103 @@ class DrawByBrush:
         # TODO: delete other expensive variables as well
         del new_feature
 
-        # Refresh the interface
-        self.iface.layerTreeView().refreshLayerSymbology(self.active_layer.id())
-        self.iface.mapCanvas().refresh()
+        # Repaint the target layer only, and only if the stroke changed it
+        # within the visible extent. The other layers are redrawn from their
+        # cached images, and an edit outside the view is rendered whenever
+        # the canvas next moves there.
+        if self.dirty_extent_visible():
+            self.active_layer.triggerRepaint()
 
         # Clean up at the end
         self.tool.reset()
 
+    def erased_geometries(self, stroke_geometry, overlapping_features):
+        """Compute the geometries left of the features overlapping a stroke
+        once the stroke is erased from them.
+
+        Args:
+            stroke_geometry: The QgsGeometry of the stroke, in the CRS of
+                self.active_layer.
+            overlapping_features: The dict returned by
+                features_overlapping_with for the stroke.
+
+        Returns:
+            A dict mapping the id of every feature that contains or partially
+            overlaps the stroke to its new QgsGeometry. The features that the
+            stroke contains are not included, as they disappear entirely.
+        """
+        geometries = overlapping_features['geometry']
+        new_geometries = {}
+        
+        # Cut a hole through all features that new_feature is contained by
+        contained_by_features = overlapping_features['contained_by']
+        for fid in contained_by_features:
+            # Get current and previous geometries
+            current_geometry = stroke_geometry
+            current_geometry.convertToMultiType() #sometimes there is only one part
+            current_polygon = current_geometry.asMultiPolygon()[0]
+            current_exterior = current_polygon[0]
+            current_holes = current_polygon[1:] 
+            
+            previous_geometry = QgsGeometry(geometries[fid])
+            previous_geometry.convertToMultiType() #sometimes previous feature is not multitype
+            previous_polygon = previous_geometry.asMultiPolygon()[0]
+            previous_exterior = previous_polygon[0]
+            previous_holes = previous_polygon[1:]
+
+            # Calculate new holes
+            previous_holes_geometry = QgsGeometry().fromMultiPolygonXY([previous_holes])
+            new_holes_geometry = QgsGeometry().fromMultiPolygonXY([[current_exterior]])
+            new_holes_geometry.combine(previous_holes_geometry)
+            new_holes = new_holes_geometry.asMultiPolygon()
+
+            # Calculate new island parts, if any
+            if current_holes != []:
+                current_holes_geometry = QgsGeometry().fromMultiPolygonXY([current_holes])
+                new_parts_geometry = current_holes_geometry.intersection(previous_geometry)
+                new_parts_geometry.convertToMultiType()  #sometimes there is only one part
+                new_parts = new_parts_geometry.asMultiPolygon()
+
+            # Add calculated holes and parts
+            new_geometry = QgsGeometry(previous_geometry)   # copy the previous geometry
+            for hole in new_holes:
+                new_geometry.addRing(hole[0])
+            if current_holes != []:
+                for part in new_parts_geometry.constParts():
+                    new_geometry.addPart(part.boundary())
+            
+            # Change feature geometry to what was calculated above
+            new_geometries[fid] = new_geometry
+
+        # For all other features, modify their geometry
+        for fid in overlapping_features['partial_overlap']:
+            previous_geometry = geometries[fid]
+            new_geometries[fid] = previous_geometry.difference(stroke_geometry)
+
+        return new_geometries
+
+    def mark_dirty(self, rect):
+        """Grow self.dirty_extent to cover a rectangle changed by the current
+        stroke.
+
+        Args:
+            rect: A QgsRectangle in the CRS of self.active_layer.
+        """
+        if self.dirty_extent is None:
+            self.dirty_extent = QgsRectangle(rect)
+        else:
+            self.dirty_extent.combineExtentWith(rect)
+
+    def dirty_extent_visible(self):
+        """Return True if the extent changed by the current stroke intersects
+        the visible extent of the map canvas."""
+        if self.dirty_extent is None:
+            return False
+        canvas = self.iface.mapCanvas()
+        extent = canvas.mapSettings().layerExtentToOutputExtent(
+            self.active_layer, self.dirty_extent)
+        return extent.intersects(canvas.extent())
+
     def set_previous_tool(self, action):
         """Reset self.previous_tool to the current active map tool. To be 
         called whenever the action is toggled."""
@@ -457,16 +663,21 @@ class DrawByBrush:
             self.previous_tool = self.iface.mapCanvas().mapTool()
 
     #------------------------------- CALCULATION ------------------------------
-    def features_overlapping_with(self, feature):
+    def features_overlapping_with(self, feature, scoped=True, exclude=()):
         """Determine which features in self.active_layer overlap with a given
-        feature, and organize them into a dict by type of overlap.
+        feature, and organize their ids into a dict by type of overlap.
         
         Args:
             feature: A QgsFeature to be checked against self.active_layer. Must
                 be in the same CRS as self.active_layer.
+            scoped: A boolean indicating whether self.class_scoped applies.
+                Defaults to True.
+            exclude: A collection of the ids of features to leave out.
+                Defaults to ().
         
         Returns:
-            A dict of features in self.active_layer that overlap with feature.
+            A dict of the ids of the features in self.active_layer that
+            overlap with feature, and of their geometries.
         
         The returned dict is of the following form:
             {
@@ -475,42 +686,167 @@ class DrawByBrush:
                 'partial_overlap': `feature` only partially overlaps these features
                 'any_overlap':     `feature` has partial or total overlap with these
                                    features
+                'geometry':        a dict mapping each of the ids above to the
+                                   QgsGeometry of the feature
             }
 
         If the two features have equivalent geometries, the feature from
-        self.active_layer is added to 'contained_by'.
+        self.active_layer is added to 'contains'.
+
+        Only the geometries of the features whose bounding box intersects that
+        of feature are fetched (see overlap_request). The geometry of feature is prepared
+        once, and each candidate is classified from a single DE-9IM
+        intersection matrix (see relation_from_matrix).
 
-        Note: If this method causes performance issues, QgsGeometryEngine
-        may provide a more efficient approach.
+        If self.class_scoped and scoped are set, only the candidates of the
+        current class are considered (see class_filter).
         """
         overlapping_features = {
             'contains': [],
             'contained_by': [],
             'partial_overlap': [],
-            'any_overlap': []
+            'any_overlap': [],
+            'geometry': {}
         }
-        for f in self.active_layer.getFeatures():
-            if feature.geometry().contains(f.geometry()):
-                overlapping_features['contains'].append(f)
-                overlapping_features['any_overlap'].append(f)
-            
-            elif (feature.geometry().within(f.geometry()) or
-                  QgsGeometry.compare(feature.geometry(), f.geometry())):
-                overlapping_features['contained_by'].append(f)
-                overlapping_features['any_overlap'].append(f)            
-            
-            elif feature.geometry().overlaps(f.geometry()):
-                overlapping_features['partial_overlap'].append(f)
-                overlapping_features['any_overlap'].append(f)
+        geometry = feature.geometry()
+        class_filter = self.class_filter() if scoped and self.class_scoped else None
+        request = self.overlap_request(geometry.boundingBox(), class_filter)
+
+        # Candidates fetched by id are not filtered by the provider, so their
+        # class is checked here, with the same expression
+        expression = None
+        if class_filter is not None:
+            expression = QgsExpression(class_filter[1])
+            context = QgsExpressionContext(
+                QgsExpressionContextUtils.globalProjectLayerScopes(self.active_layer))
+            expression.prepare(context)
+
+        engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+        engine.prepareGeometry()
+
+        exclude = set(exclude)
+        for f in self.active_layer.getFeatures(request):
+            if f.id() in exclude:
+                continue
+            if expression is not None:
+                context.setFeature(f)
+                if not expression.evaluate(context):
+                    continue
+            f_geometry = f.geometry()
+            relation = relation_from_matrix(engine.relate(f_geometry.constGet()))
+            if relation is not None:
+                overlapping_features[relation].append(f.id())
+                overlapping_features['any_overlap'].append(f.id())
+                overlapping_features['geometry'][f.id()] = f_geometry
         
         return overlapping_features
 
+    def overlap_request(self, bbox, class_filter=None):
+        """Build the request fetching the features that may overlap a
+        bounding box.
+
+        Candidates come from the spatial index of self.active_layer, or from
+        the provider's own rectangle filter while the index is being built.
+        No attributes are fetched, since overlapping features only have
+        their geometry changed, and geometries are never simplified.
+
+        If a class filter is given, only the class field is fetched. While
+        the index is being built, the provider also filters the candidates on
+        the class expression. A request cannot filter on both feature ids and
+        an expression, so candidates taken from the index have their class
+        checked by the caller.
+
+        Args:
+            bbox: A QgsRectangle in the CRS of self.active_layer.
+            class_filter: The tuple returned by class_filter, or None.
+                Defaults to None.
+
+        Returns:
+            A QgsFeatureRequest.
+        """
+        request = QgsFeatureRequest()
+        fids = self.layer_index(self.active_layer).candidates(bbox)
+        if fids is None:
+            request.setFilterRect(bbox)
+            if class_filter is not None:
+                request.setFilterExpression(class_filter[1])
+        else:
+            request.setFilterFids(fids)
+        if class_filter is not None:
+            request.setSubsetOfAttributes([class_filter[0]])
+        else:
+            request.setNoAttributes()
+        request.setSimplifyMethod(QgsSimplifyMethod())
+        return request
+
+    def class_filter(self):
+        """Build the expression selecting the features of the current class
+        in self.active_layer.
+
+        Returns:
+            A tuple of the index of the class field and the expression string,
+            or None if the layer has no class field or there is no current
+            class.
+        """
+        class_field_name = self._get_class_field() if self._get_class_field else "class"
+        class_idx = self.active_layer.fields().indexFromName(class_field_name)
+        class_value = self._get_class_value() if self._get_class_value else None
+        if class_idx == -1 or class_value is None:
+            return None
+
+        return class_idx, QgsExpression.createFieldEqualityExpression(
+            class_field_name, class_value)
+
     def get_active_layer(self):
         """Reset the reference to the current active layer and reconnect 
         signals to slots as necessary. To be called whenever the active layer
-        changes."""
+        changes.
+
+        The editing hooks of the previous layer are disconnected, so that
+        every edit toggle runs brush_action_requirements_check only once
+        however often the layers are switched."""
+        if self.hooked_layer is not None:
+            self.connections.disconnect(owner=self, sender=self.hooked_layer)
+            self.hooked_layer = None
+
         self.active_layer = self.iface.activeLayer()
         if ((self.active_layer != None) and
             (self.active_layer.type() == QgsMapLayer.VectorLayer)):
-            self.active_layer.editingStarted.connect(self.brush_action_requirements_check)
-            self.active_layer.editingStopped.connect(self.brush_action_requirements_check)
\ No newline at end of file
+            for signal in ('editingStarted', 'editingStopped'):
+                self.connections.connect(self.active_layer, signal,
+                                         self.brush_action_requirements_check,
+                                         owner=self)
+            self.hooked_layer = self.active_layer
+
+    def release_layer_indexes(self):
+        """Release the spatial indexes of all layers."""
+        while self.layer_indexes:
+            self.layer_indexes.popitem()[1].release()
+
+    def layer_index(self, layer):
+        """Return the spatial index of a layer, creating it if needed.
+
+        Indexes are only built for the layers actually drawn into, on their
+        first stroke. The max_layer_indexes most recently used ones are kept,
+        so that switching between a few layers does not index them again.
+
+        Args:
+            layer: A QgsVectorLayer.
+
+        Returns:
+            The LayerIndex of layer.
+        """
+        index = self.layer_indexes.get(layer.id())
+        if index is None or index.layer is None:
+            index = LayerIndex(layer, self.connections)
+            self.layer_indexes[layer.id()] = index
+        self.layer_indexes.move_to_end(layer.id())
+
+        # Forget the indexes of deleted layers, and release the least
+        # recently used ones
+        for key in [key for key, value in self.layer_indexes.items()
+                    if value.layer is None]:
+            del self.layer_indexes[key]
+        while len(self.layer_indexes) > self.max_layer_indexes:
+            self.layer_indexes.popitem(last=False)[1].release()
+        return index
\ No newline at end of file
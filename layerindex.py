@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Spatial index of the layers drawn into with the Brush Tool.
+
+Finding the features a stroke overlaps used to mean testing every feature of
+the layer. The index here keeps the bounding box of every feature in a
+QgsSpatialIndex, built in a background task and then kept in step with the
+edit buffer, so that only the features near the stroke are fetched.
+"""
+from qgis.core import QgsApplication, QgsFeature, QgsFeatureRequest, \
+    QgsGeometry, QgsRectangle, QgsSpatialIndex, QgsTask, \
+    QgsVectorLayerFeatureSource
+
+
+def box(rect):
+    """Return the (xmin, ymin, xmax, ymax) tuple of a QgsRectangle.
+
+    Plain tuples are kept instead of the rectangles themselves, as each
+    QgsRectangle wrapper costs far more memory on layers of hundreds of
+    thousands of features.
+    """
+    return (rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum())
+
+
+def read_bounds(source, task=None):
+    """Index the bounding box of every feature of a feature source.
+
+    Args:
+        source: The QgsFeatureSource to read, such as a QgsVectorLayer or a
+            QgsVectorLayerFeatureSource.
+        task: An optional QgsTask, checked for cancellation. Defaults to
+            None.
+
+    Returns:
+        A tuple of a dict mapping each feature id to its bounding box (see
+        box), and the QgsSpatialIndex of those boxes, or None if the task was
+        canceled.
+    """
+    bounds = {}
+    index = QgsSpatialIndex()
+    request = QgsFeatureRequest().setNoAttributes()
+    for feature in source.getFeatures(request):
+        if task is not None and task.isCanceled():
+            return None
+        if feature.hasGeometry():
+            rect = feature.geometry().boundingBox()
+            bounds[feature.id()] = box(rect)
+            index.addFeature(feature.id(), rect)
+    return bounds, index
+
+
+class IndexTask(QgsTask):
+    """Background task indexing a snapshot of a layer.
+
+    Attributes:
+        source: The QgsVectorLayerFeatureSource snapshot of the layer, taken
+            when the task is created.
+        callback: The callable receiving the result of read_bounds once the
+            task has finished.
+        result: The result of read_bounds, or None.
+    """
+
+    def __init__(self, layer, callback):
+        """Constructor for the index task.
+
+        Args:
+            layer: The QgsVectorLayer to index.
+            callback: A callable receiving the result of read_bounds, called
+                on the main thread once the task has finished successfully.
+        """
+        QgsTask.__init__(self, 'Indexing {}'.format(layer.name()),
+                         QgsTask.CanCancel)
+        self.source = QgsVectorLayerFeatureSource(layer)
+        self.callback = callback
+        self.result = None
+
+    def run(self):
+        """Index the snapshot, off the main thread."""
+        self.result = read_bounds(self.source, self)
+        return self.result is not None
+
+    def finished(self, result):
+        """Hand the index over, on the main thread."""
+        if result:
+            self.callback(self.result)
+
+
+class LayerIndex:
+    """Spatial index of the feature bounding boxes of a vector layer, kept in
+    step with its edit buffer.
+
+    Small layers are indexed immediately, larger ones (and those whose
+    feature count is unknown) in a background task.
+    Edits made while the task runs are recorded and replayed once it is
+    done. The index is rebuilt after the edits are committed or rolled back,
+    since committing may change the feature ids.
+
+    Attributes:
+        layer: The QgsVectorLayer indexed, or None once released.
+        connections: The ConnectionRegistry through which the layer signals
+            are connected.
+        background_threshold: An integer number of features above which the
+            layer is indexed in a background task.
+        bounds: A dict mapping each feature id to the (xmin, ymin, xmax,
+            ymax) tuple of its bounding box.
+        index: The QgsSpatialIndex of the bounding boxes, or None while it is
+            being built.
+        pending: A list of the (feature id, bounding box tuple or None) edits
+            recorded while the index is being built, or None.
+        task: The IndexTask building the index, or None.
+
+    Methods:
+        rebuild: Index the layer from scratch.
+        is_ready: Check whether the index can be queried.
+        candidates: Return the ids of the features whose bounding box
+            intersects a rectangle.
+        release: Disconnect from the layer and drop the index.
+    """
+
+    def __init__(self, layer, connections, background_threshold=1000):
+        """Constructor for the layer index.
+
+        Args:
+            layer: The QgsVectorLayer to index.
+            connections: The ConnectionRegistry through which the layer
+                signals are connected.
+            background_threshold: An integer number of features above which
+                the layer is indexed in a background task. Defaults to 1000,
+                which takes a few milliseconds to index on the main thread.
+        """
+        self.layer = layer
+        self.connections = connections
+        self.background_threshold = background_threshold
+        self.bounds = {}
+        self.index = None
+        self.pending = None
+        self.task = None
+
+        for signal, slot in (('featureAdded', self.on_feature_added),
+                             ('featureDeleted', self.on_feature_deleted),
+                             ('geometryChanged', self.on_geometry_changed),
+                             ('afterCommitChanges', self.rebuild),
+                             ('afterRollBack', self.rebuild),
+                             ('willBeDeleted', self.release)):
+            connections.connect(layer, signal, slot, owner=self)
+
+        self.rebuild()
+
+    def rebuild(self):
+        """Index the layer from scratch, in the background if it is large."""
+        self._cancel_task()
+        self.bounds = {}
+        self.index = None
+
+        # A negative count means the provider does not know it without a scan
+        count = self.layer.featureCount()
+        if 0 <= count <= self.background_threshold:
+            self.pending = None
+            self.bounds, self.index = read_bounds(self.layer)
+        else:
+            self.pending = []
+            self.task = IndexTask(self.layer, self._on_task_finished)
+            QgsApplication.taskManager().addTask(self.task)
+
+    def is_ready(self):
+        """Return True if the index can be queried."""
+        return self.index is not None
+
+    def candidates(self, rect):
+        """Return the ids of the features whose bounding box intersects a
+        rectangle.
+
+        Args:
+            rect: A QgsRectangle in the layer CRS.
+
+        Returns:
+            A list of feature ids, or None if the index is still being built.
+        """
+        if self.index is None:
+            return None
+        return self.index.intersects(rect)
+
+    def release(self):
+        """Disconnect from the layer and drop the index."""
+        self.connections.disconnect(owner=self)
+        self._cancel_task()
+        self.layer = None
+        self.bounds = {}
+        self.index = None
+        self.pending = None
+
+    #------------------------------ UPPDATE STATE -----------------------------
+    def on_feature_added(self, fid):
+        """Index a feature added to the edit buffer."""
+        feature = self.layer.getFeature(fid)
+        rect = box(feature.geometry().boundingBox()) if feature.hasGeometry() else None
+        self._record(fid, rect)
+
+    def on_feature_deleted(self, fid):
+        """Remove a feature deleted from the edit buffer."""
+        self._record(fid, None)
+
+    def on_geometry_changed(self, fid, geometry):
+        """Move a feature whose geometry changed in the edit buffer."""
+        self._record(fid, None if geometry.isNull() else box(geometry.boundingBox()))
+
+    def _record(self, fid, rect):
+        """Apply an edit, or keep it for later if the index is being built."""
+        if self.pending is not None:
+            self.pending.append((fid, rect))
+        elif self.index is not None:
+            self._apply(fid, rect)
+
+    def _apply(self, fid, rect):
+        """Replace the bounding box tuple of a feature (None to remove it)."""
+        previous = self.bounds.pop(fid, None)
+        if previous is not None:
+            # The index finds entries to delete by their bounding box
+            feature = QgsFeature(fid)
+            feature.setGeometry(QgsGeometry.fromRect(QgsRectangle(*previous)))
+            self.index.deleteFeature(feature)
+        if rect is not None:
+            self.bounds[fid] = rect
+            self.index.addFeature(fid, QgsRectangle(*rect))
+
+    def _on_task_finished(self, result):
+        """Take over the index built in the background and replay the edits
+        made meanwhile."""
+        self.task = None
+        self.bounds, self.index = result
+        pending, self.pending = self.pending or [], None
+        for fid, rect in pending:
+            self._apply(fid, rect)
+
+    def _cancel_task(self):
+        """Cancel the background task, if any."""
+        if self.task is not None:
+            self.task.callback = lambda result: None
+            self.task.cancel()
+            self.task = None
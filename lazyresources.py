@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy registration of the compiled Qt resources.
+
+resources.py embeds every icon of the brush as a large byte literal and
+registers them with Qt as soon as it is imported. Importing it only when a
+resource path (':/...') is first used keeps that cost out of QGIS startup
+for users who never open the brush.
+"""
+from importlib import import_module
+
+_resources = None
+
+
+def load_resources():
+    """Register the compiled Qt resources, the first time only.
+
+    Returns:
+        The resources module.
+    """
+    global _resources
+    if _resources is None:
+        # Importing the module registers its resources with Qt
+        _resources = import_module('.resources', __package__)
+    return _resources
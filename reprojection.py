@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Reprojection helpers for the Brush Tool.
+
+Strokes are drawn in the project CRS and may have to be reprojected to the CRS
+of the layer they are drawn into. The helpers here keep the coordinate
+transform and the local scale factors between both CRS around, so that they
+are not rebuilt for every stroke.
+"""
+import struct
+
+import numpy as np
+
+from qgis.core import QgsCoordinateTransform, QgsCsException, QgsGeometry, \
+    QgsProject
+
+
+def transform_vertices(transform, vertices):
+    """Transform an array of vertices in a single call.
+
+    Args:
+        transform: The QgsCoordinateTransform to apply.
+        vertices: A numpy array of shape (n, 2) containing the vertices.
+
+    Returns:
+        A numpy array of shape (n, 2) containing the transformed vertices.
+
+    Raises:
+        QgsCsException: If the vertices cannot be transformed.
+    """
+    vertices = np.ascontiguousarray(vertices, dtype='<f8')
+    line = QgsGeometry()
+    line.fromWkb(struct.pack('<BII', 1, 2, len(vertices)) + vertices.tobytes())
+    line.transform(transform)
+
+    # Skip the byte order, type and vertex count of the linestring WKB
+    wkb = bytes(line.asWkb())
+    return np.frombuffer(wkb, dtype='<f8', offset=9).reshape(-1, 2)
+
+
+class CrsContext:
+    """Coordinate transform and local scale factors between the project CRS
+    and the CRS of a layer.
+
+    The scale factors are sampled on a regular grid over the current map
+    extent the first time they are needed, and resampled after the extent
+    changes (see invalidate) or when asked for a point outside of it.
+
+    Attributes:
+        source_crs: The QgsCoordinateReferenceSystem of the project.
+        destination_crs: The QgsCoordinateReferenceSystem of the layer.
+        transform: The QgsCoordinateTransform from source_crs to
+            destination_crs.
+        grid_size: An integer number of grid nodes along each side of the
+            extent.
+        extent: The QgsRectangle over which the scale factors were sampled,
+            or None if they have to be resampled.
+        scale_grid: A numpy array of shape (grid_size, grid_size) containing
+            the linear scale factor at each grid node, or None.
+
+    Methods:
+        invalidate: Mark the scale factors as stale.
+        scale_factor_at: Return the linear scale factor near a point.
+    """
+
+    def __init__(self, source_crs, destination_crs, grid_size=5):
+        """Constructor for the CRS context.
+
+        Args:
+            source_crs: The QgsCoordinateReferenceSystem of the project.
+            destination_crs: The QgsCoordinateReferenceSystem of the layer.
+            grid_size: An integer number of grid nodes along each side of the
+                extent. Defaults to 5.
+        """
+        self.source_crs = source_crs
+        self.destination_crs = destination_crs
+        self.transform = QgsCoordinateTransform(
+            source_crs, destination_crs, QgsProject.instance())
+        self.grid_size = grid_size
+        self.invalidate()
+
+    def invalidate(self):
+        """Mark the scale factors as stale, e.g. when the map extent changes."""
+        self.extent = None
+        self.scale_grid = None
+
+    def scale_factor_at(self, point, extent):
+        """Return the linear scale factor between both CRS near a point.
+
+        Args:
+            point: A QgsPointXY in the project CRS.
+            extent: A QgsRectangle of the current map extent, used to sample
+                the scale factors if they are stale or do not cover point.
+
+        Returns:
+            A float by which a distance in project CRS units around point
+            must be multiplied to get the distance in layer CRS units.
+        """
+        if self.scale_grid is None or not self.extent.contains(point):
+            self._sample(extent)
+
+        # Use the grid node nearest to the point
+        last = self.grid_size - 1
+        i = round((point.x() - self.extent.xMinimum()) / self.extent.width() * last)
+        j = round((point.y() - self.extent.yMinimum()) / self.extent.height() * last)
+        return float(self.scale_grid[min(max(j, 0), last), min(max(i, 0), last)])
+
+    def _sample(self, extent):
+        """Sample the scale factors on a regular grid over an extent."""
+        self.extent = extent
+        xs = np.linspace(extent.xMinimum(), extent.xMaximum(), self.grid_size)
+        ys = np.linspace(extent.yMinimum(), extent.yMaximum(), self.grid_size)
+        x, y = (a.ravel() for a in np.meshgrid(xs, ys))
+
+        # Transform each node and two nearby points in a single call, and
+        # take the square root of the area scale of the local Jacobian
+        step = max(extent.width(), extent.height()) * 1e-4
+        nodes = np.column_stack((x, y))
+        vertices = np.vstack((nodes, nodes + (step, 0), nodes + (0, step)))
+        try:
+            transformed = transform_vertices(self.transform, vertices)
+        except QgsCsException:
+            self.scale_grid = np.ones((self.grid_size, self.grid_size))
+            return
+
+        origin, east, north = np.split(transformed, 3)
+        dx, dy = east - origin, north - origin
+        area = np.abs(dx[:, 0]*dy[:, 1] - dx[:, 1]*dy[:, 0]) / (step*step)
+        self.scale_grid = np.sqrt(area).reshape(self.grid_size, self.grid_size)
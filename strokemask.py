@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+Raster stroke accumulation for the Brush Tool.
+
+Instead of recording vector samples, the brush is stamped into a boolean mask
+with one cell per screen pixel (or per cell_size map units). Stamping only
+touches the cells around the brush, so a mouse move costs the same however
+long the stroke already is, and no geometry is built until the stroke is
+finished. The mask is then traced once with marching squares, simplified and
+turned into a polygon.
+"""
+from math import floor
+
+import numpy as np
+
+from qgis.core import QgsGeometry
+
+from .strokes import multipolygon_from_rings, project_rings, simplify_indices
+
+# Direction vectors of the traced cell edges: +x, +y, -x, -y. Turning left
+# from direction d gives direction (d + 1) % 4.
+DIRECTIONS = np.array([(1, 0), (0, 1), (-1, 0), (0, -1)])
+
+
+def trace_contours(mask):
+    """Trace the contours of a boolean mask with marching squares.
+
+    Rows of the mask run along y and columns along x, and cell (i, j) covers
+    the square between corners (j, i) and (j + 1, i + 1). The contour
+    vertices lie halfway along the cell edges separating filled cells from
+    empty ones, and only the vertices where the contour turns are kept.
+    Diagonally touching cells are kept apart, so the contours never touch.
+
+    Args:
+        mask: A 2D numpy array of booleans.
+
+    Returns:
+        A list of numpy arrays of shape (n, 2) containing the vertices of each
+        contour (without the closing vertex), in cell units. Exterior rings
+        are counterclockwise and holes clockwise.
+    """
+    padded = np.pad(mask, 1)
+    height, width = padded.shape
+
+    # Every edge between a filled and an empty cell, walked with the filled
+    # cell on its left: bottom, top, right then left edges of filled cells
+    starts, directions = [], []
+    for filled, offset, direction in (
+            (padded[1:, :] & ~padded[:-1, :], (0, 1), 0),
+            (padded[:-1, :] & ~padded[1:, :], (1, 1), 2),
+            (padded[:, :-1] & ~padded[:, 1:], (1, 0), 1),
+            (padded[:, 1:] & ~padded[:, :-1], (1, 1), 3)):
+        rows, columns = np.nonzero(filled)
+        starts.append(np.column_stack((columns + offset[0], rows + offset[1])))
+        directions.append(np.full(len(rows), direction))
+    starts = np.vstack(starts)
+    directions = np.concatenate(directions)
+    ends = starts + DIRECTIONS[directions]
+
+    # Link the edges into rings. Saddle corners have two outgoing edges, in
+    # which case the contour turns left.
+    start_keys = (starts[:, 1] * (width + 1) + starts[:, 0]).tolist()
+    end_keys = (ends[:, 1] * (width + 1) + ends[:, 0]).tolist()
+    direction_list = directions.tolist()
+    outgoing = {}
+    for edge, key in enumerate(start_keys):
+        outgoing.setdefault(key, []).append(edge)
+
+    used = [False] * len(start_keys)
+    middles = starts + DIRECTIONS[directions] / 2
+    contours = []
+    for first in range(len(start_keys)):
+        if used[first]:
+            continue
+        ring = []
+        edge = first
+        while not used[edge]:
+            used[edge] = True
+            ring.append(edge)
+            options = outgoing[end_keys[edge]]
+            edge = options[0]
+            if len(options) > 1:
+                left = (direction_list[ring[-1]] + 1) % 4
+                edge = next(e for e in options if direction_list[e] == left)
+
+        # Keep the vertices where the contour turns
+        ring_directions = directions[ring]
+        turns = ((ring_directions != np.roll(ring_directions, 1)) |
+                 (ring_directions != np.roll(ring_directions, -1)))
+        contours.append(middles[ring][turns])
+
+    return contours
+
+
+def signed_area(ring):
+    """Return the area of a ring, positive if it is counterclockwise."""
+    x, y = ring[:, 0], ring[:, 1]
+    return (np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2
+
+
+def ring_contains(ring, point):
+    """Check whether a point lies inside a ring, by ray casting."""
+    x, y = ring[:, 0], ring[:, 1]
+    next_x, next_y = np.roll(x, -1), np.roll(y, -1)
+    px, py = point
+    crosses = (y > py) != (next_y > py)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        at = x + (py - y) * (next_x - x) / (next_y - y)
+    return bool(np.count_nonzero(crosses & (px < at)) % 2)
+
+
+class StrokeMask:
+    """Record a brush stroke as a boolean mask and vectorize it on demand.
+
+    The mask is laid out on a grid of cell_size map units anchored at the
+    first sample, and grows (doubling its size) whenever the brush leaves it.
+    It has the same interface as StrokeAccumulator, so the Brush Tool can use
+    either engine.
+
+    Attributes:
+        radius: A float representing the brush radius in map units.
+        cell_size: A float representing the size of a cell in map units.
+        project: A callable transforming a numpy array of shape (n, 2) from
+            map coordinates to the target CRS, or None if no reprojection is
+            necessary.
+        scale: A float by which distances in map units must be multiplied to
+            get distances in the target CRS.
+        tolerance: A float representing the maximum distance in map units
+            between the traced and the simplified contours.
+        origin: A tuple of the (x, y) map coordinates of the grid origin, or
+            None if nothing has been stamped yet.
+        mask: A 2D numpy array of booleans, with rows along y.
+        offset: A tuple of the (column, row) grid indices of mask[0, 0].
+        previous: A tuple of the (x, y) map coordinates of the last sample of
+            the centreline, or None.
+        stamps: An integer counting the brush stamps.
+
+    Methods:
+        add_point: Stamp the brush along the centreline up to a sample.
+        skip_to: Move the end of the centreline without stamping.
+        add_polygon: Stamp a convex swept brush shape.
+        is_empty: Check whether anything has been stamped.
+        has_pending: Always False, as the mask is kept in map coordinates.
+        project_pending: Do nothing, as the mask is reprojected on release.
+        settle: Do nothing, as the mask never grows with stroke length.
+        geometry: Vectorize the mask into the polygon covered by the stroke.
+    """
+
+    def __init__(self, radius, cell_size, project=None, scale=1, tolerance=0):
+        """Constructor for the stroke mask.
+
+        Args:
+            radius: A float representing the brush radius in map units.
+            cell_size: A float representing the size of a cell in map units.
+            project: An optional callable transforming a numpy array of shape
+                (n, 2) from map coordinates to the target CRS. Defaults to
+                None, which means that no reprojection is necessary.
+            scale: A float by which distances in map units must be multiplied
+                to get distances in the target CRS. Defaults to 1.
+            tolerance: A float representing the maximum distance in map units
+                between the traced and the simplified contours. Defaults to 0.
+        """
+        self.radius = radius
+        self.cell_size = cell_size
+        self.project = project
+        self.scale = scale
+        self.tolerance = tolerance
+        self.origin = None
+        self.mask = np.zeros((0, 0), dtype=bool)
+        self.offset = (0, 0)
+        self.previous = None
+        self.stamps = 0
+
+    def add_point(self, point):
+        """Stamp the brush along the segment from the previous sample to a
+        point, or around the point if it is the first sample.
+
+        Args:
+            point: A QgsPointXY in map coordinates.
+        """
+        x, y = point.x(), point.y()
+        x0, y0 = self.previous if self.previous is not None else (x, y)
+        self.previous = (x, y)
+
+        r = self.radius
+        window = self._window(min(x0, x) - r, min(y0, y) - r,
+                              max(x0, x) + r, max(y0, y) + r)
+        rows, columns, cx, cy = window
+
+        # Distance from each cell center to the segment
+        dx, dy = x - x0, y - y0
+        length = dx*dx + dy*dy
+        px, py = cx - x0, cy - y0
+        if length:
+            t = np.clip((px*dx + py*dy) / length, 0, 1)
+            px, py = px - t*dx, py - t*dy
+        self.mask[rows, columns] |= px*px + py*py <= r*r
+        self.stamps += 1
+
+    def skip_to(self, point):
+        """Move the end of the centreline to a point without stamping, for
+        moves over an area that is already painted.
+
+        Args:
+            point: A QgsPointXY in map coordinates.
+        """
+        self.previous = (point.x(), point.y())
+
+    def add_polygon(self, vertices):
+        """Stamp a convex swept brush shape.
+
+        Args:
+            vertices: A numpy array of shape (n, 2) containing the vertices of
+                a convex polygon in map coordinates.
+        """
+        vertices = np.asarray(vertices, dtype=float)
+        if signed_area(vertices) < 0:
+            vertices = vertices[::-1]
+
+        (xmin, ymin), (xmax, ymax) = vertices.min(axis=0), vertices.max(axis=0)
+        rows, columns, cx, cy = self._window(xmin, ymin, xmax, ymax)
+
+        # Cell centers on the left of every edge are inside
+        inside = np.ones((len(cy), cx.shape[1]), dtype=bool)
+        for (ax, ay), (bx, by) in zip(vertices, np.roll(vertices, -1, axis=0)):
+            inside &= (bx - ax)*(cy - ay) - (by - ay)*(cx - ax) >= 0
+        self.mask[rows, columns] |= inside
+        self.stamps += 1
+
+    def is_empty(self):
+        """Return True if nothing has been stamped yet."""
+        return self.stamps == 0
+
+    def has_pending(self):
+        """Return False, as the mask is only reprojected once vectorized."""
+        return False
+
+    def project_pending(self):
+        """Do nothing, as the mask is only reprojected once vectorized."""
+
+    def settle(self):
+        """Do nothing, as the size of the mask does not depend on the number
+        of samples.
+
+        Returns:
+            False, since the stroke never changes.
+        """
+        return False
+
+    def geometry(self):
+        """Vectorize the mask into the polygon covered by the stroke.
+
+        The contours are traced, simplified within tolerance, converted to map
+        coordinates, reprojected in a single batch if necessary, and every
+        hole is assigned to the smallest exterior ring containing it.
+
+        Returns:
+            A QgsGeometry (of type QgsWkbTypes.PolygonGeometry), in the target
+            CRS if reprojecting.
+        """
+        if self.is_empty():
+            return QgsGeometry()
+
+        tolerance = self.tolerance / self.cell_size
+        rings = []
+        for ring in trace_contours(self.mask):
+            if tolerance and len(ring) > 4:
+                keep = simplify_indices(np.vstack((ring, ring[:1])), tolerance)
+                if len(keep) > 3:
+                    ring = ring[keep[:-1]]
+            rings.append(ring)
+
+        # The padding of the traced mask shifts the contours by one cell
+        corner = np.array(self.offset) - 1
+        origin = np.array(self.origin)
+        rings = [origin + (corner + ring) * self.cell_size for ring in rings]
+
+        areas = [signed_area(ring) for ring in rings]
+        exteriors = sorted((i for i, area in enumerate(areas) if area > 0),
+                           key=lambda i: areas[i])
+        polygons = {i: [rings[i]] for i in exteriors}
+        for i, area in enumerate(areas):
+            if area < 0:
+                owner = next((j for j in exteriors
+                              if ring_contains(rings[j], rings[i][0])), None)
+                if owner is not None:
+                    polygons[owner].append(rings[i])
+        polygons = [polygons[i] for i in exteriors]
+
+        if self.project is not None:
+            polygons = project_rings(polygons, self.project)
+
+        geometry = multipolygon_from_rings(polygons)
+        if not geometry.isGeosValid():
+            geometry = geometry.makeValid()
+        return geometry
+
+    def _window(self, xmin, ymin, xmax, ymax):
+        """Grow the mask to cover a rectangle in map coordinates.
+
+        Returns:
+            A tuple of the row slice and column slice of the mask covering the
+            rectangle, and the x (as a row vector) and y (as a column vector)
+            map coordinates of the centers of those cells.
+        """
+        if self.origin is None:
+            self.origin = (xmin, ymin)
+        size = self.cell_size
+        c0 = floor((xmin - self.origin[0]) / size)
+        r0 = floor((ymin - self.origin[1]) / size)
+        c1 = floor((xmax - self.origin[0]) / size) + 1
+        r1 = floor((ymax - self.origin[1]) / size) + 1
+        self._reserve(c0, r0, c1, r1)
+
+        columns = np.arange(c0, c1)
+        rows = np.arange(r0, r1)
+        cx = (self.origin[0] + (columns + 0.5) * size)[np.newaxis, :]
+        cy = (self.origin[1] + (rows + 0.5) * size)[:, np.newaxis]
+        col, row = self.offset
+        return slice(r0 - row, r1 - row), slice(c0 - col, c1 - col), cx, cy
+
+    def _reserve(self, c0, r0, c1, r1):
+        """Grow the mask so that it covers columns c0 to c1 and rows r0 to r1
+        (excluded), at least doubling its size to keep growth amortized."""
+        col, row = self.offset
+        height, width = self.mask.shape
+        if (c0 >= col and r0 >= row and c1 <= col + width and
+                r1 <= row + height):
+            return
+
+        if self.mask.size == 0:
+            new_col, new_row, new_width, new_height = c0, r0, c1 - c0, r1 - r0
+        else:
+            new_col = min(c0, col - (width if c0 < col else 0))
+            new_row = min(r0, row - (height if r0 < row else 0))
+            new_width = max(c1, col + width + (width if c1 > col + width else 0)) - new_col
+            new_height = max(r1, row + height + (height if r1 > row + height else 0)) - new_row
+
+        mask = np.zeros((new_height, new_width), dtype=bool)
+        if self.mask.size:
+            mask[row - new_row:row - new_row + height,
+                 col - new_col:col - new_col + width] = self.mask
+        self.mask = mask
+        self.offset = (new_col, new_row)
@@ -0,0 +1,833 @@
+# -*- coding: utf-8 -*-
+"""
+Stroke accumulation for the Brush Tool.
+
+A brush stroke is recorded as a list of samples while the mouse is dragged
+and only turned into a polygon once, when the stroke is finished. This keeps
+the cost of a mouse move independent of the length of the stroke.
+"""
+from functools import lru_cache
+from math import cos, sin, pi, radians, floor, sqrt, ceil, acos
+import struct
+
+import numpy as np
+
+from qgis.core import QgsGeometry
+
+# Unit vertices (angle in degrees, counterclockwise from the brush direction)
+# of the brush shapes other than the circle, which are inscribed in the unit
+# circle so that brush_radius is the distance from the center to the corners.
+SHAPE_ANGLES = {
+    'wedge': (0, 150, 210),
+    'rectangle': (30, 150, 210, 330),
+}
+
+
+def points_for_radius(radius, tolerance, minimum=8, maximum=256):
+    """Compute how many vertices are needed to approximate a circle.
+
+    Args:
+        radius: A number representing the radius of the circle in pixels.
+        tolerance: A number representing the maximum distance in pixels
+            between the circle and the polygon approximating it.
+        minimum: An integer lower bound on the number of vertices. Defaults
+            to 8.
+        maximum: An integer upper bound on the number of vertices. Defaults
+            to 256.
+
+    Returns:
+        An integer number of vertices.
+    """
+    if radius <= tolerance:
+        return minimum
+    points = ceil(pi / acos(1 - tolerance / radius))
+    return max(minimum, min(maximum, points))
+
+
+@lru_cache(maxsize=64)
+def shape_template(shape, num_points):
+    """Compute the unit vertices of a brush shape once.
+
+    Args:
+        shape: A string of the name of the brush shape.
+        num_points: An integer number of points to use when approximating a
+            circle. Ignored for the other shapes.
+
+    Returns:
+        A read-only numpy array of shape (n, 2) containing the vertices of the
+        exterior ring of the shape (without the closing vertex), centered on
+        the origin with a radius of 1.
+    """
+    if shape == 'circle':
+        theta = np.arange(num_points - 1) * (2.0 * pi / (num_points - 1))
+    else:
+        theta = np.radians(SHAPE_ANGLES[shape])
+
+    template = np.column_stack((np.cos(theta), np.sin(theta)))
+    template.setflags(write=False)
+    return template
+
+
+@lru_cache(maxsize=64)
+def inner_radius(shape, num_points):
+    """Compute the radius of the largest circle centered on the origin that
+    fits inside the unit template of a brush shape.
+
+    Args:
+        shape: A string of the name of the brush shape.
+        num_points: An integer number of points to use when approximating a
+            circle. Ignored for the other shapes.
+
+    Returns:
+        A float between 0 and 1.
+    """
+    template = shape_template(shape, num_points)
+    edges = np.roll(template, -1, axis=0) - template
+    cross = np.abs(template[:, 0]*edges[:, 1] - template[:, 1]*edges[:, 0])
+    return float(np.min(cross / np.hypot(edges[:, 0], edges[:, 1])))
+
+
+def stamp_vertices(shape, num_points, center, radius, angle=0):
+    """Scale, rotate and translate the template of a brush shape.
+
+    Args:
+        shape: A string of the name of the brush shape.
+        num_points: An integer number of points to use when approximating a
+            circle.
+        center: A QgsPointXY indicating the center of the brush.
+        radius: A float representing the radius of the brush in map units.
+        angle: A float representing the angle of the brush in degrees,
+            clockwise as seen on screen. Defaults to 0.
+
+    Returns:
+        A numpy array of shape (n, 2) containing the vertices of the brush.
+    """
+    c, s = cos(radians(angle)), sin(radians(angle))
+    transformation = np.array([[c, -s], [s, c]]) * radius
+    return shape_template(shape, num_points) @ transformation \
+        + (center.x(), center.y())
+
+
+def polygon_from_vertices(vertices):
+    """Build a polygon geometry from an array of vertices in a single call.
+
+    Args:
+        vertices: A numpy array of shape (n, 2) containing the vertices of the
+            exterior ring (without the closing vertex).
+
+    Returns:
+        A QgsGeometry (of type QgsWkbTypes.PolygonGeometry).
+    """
+    ring = np.vstack((vertices, vertices[:1])).astype('<f8')
+    wkb = struct.pack('<BIII', 1, 3, 1, len(ring)) + ring.tobytes()
+
+    geometry = QgsGeometry()
+    geometry.fromWkb(wkb)
+    return geometry
+
+
+def multipolygon_from_vertices(polygons):
+    """Build a multipolygon geometry from a list of arrays of vertices in a
+    single call.
+
+    Args:
+        polygons: A list of numpy arrays of shape (n, 2), each containing the
+            vertices of the exterior ring of a part (without the closing
+            vertex).
+
+    Returns:
+        A QgsGeometry (of type QgsWkbTypes.PolygonGeometry) with one part per
+        array. The parts are not unioned and may overlap.
+    """
+    chunks = [struct.pack('<BII', 1, 6, len(polygons))]
+    for vertices in polygons:
+        ring = np.vstack((vertices, vertices[:1])).astype('<f8')
+        chunks.append(struct.pack('<BIII', 1, 3, 1, len(ring)))
+        chunks.append(ring.tobytes())
+
+    geometry = QgsGeometry()
+    geometry.fromWkb(b''.join(chunks))
+    return geometry
+
+
+def multipolygon_from_rings(polygons):
+    """Build a multipolygon geometry with holes from a list of rings in a
+    single call.
+
+    Args:
+        polygons: A list of lists of numpy arrays of shape (n, 2). Each list
+            holds the exterior ring of a part followed by its holes (without
+            the closing vertices).
+
+    Returns:
+        A QgsGeometry (of type QgsWkbTypes.PolygonGeometry) with one part per
+        list.
+    """
+    chunks = [struct.pack('<BII', 1, 6, len(polygons))]
+    for rings in polygons:
+        chunks.append(struct.pack('<BII', 1, 3, len(rings)))
+        for vertices in rings:
+            ring = np.vstack((vertices, vertices[:1])).astype('<f8')
+            chunks.append(struct.pack('<I', len(ring)))
+            chunks.append(ring.tobytes())
+
+    geometry = QgsGeometry()
+    geometry.fromWkb(b''.join(chunks))
+    return geometry
+
+
+def polygon_rings(geometry):
+    """Return the rings of a polygon geometry as arrays of vertices.
+
+    The rings are read straight from the WKB of the geometry, without
+    creating a point object per vertex.
+
+    Args:
+        geometry: A QgsGeometry (of type QgsWkbTypes.PolygonGeometry) of
+            2D polygons.
+
+    Returns:
+        A list of lists of read-only numpy arrays of shape (n, 2). Each list
+        holds the exterior ring of a part followed by its holes (without the
+        closing vertices).
+
+    Raises:
+        ValueError: If the geometry is neither a polygon nor a multipolygon.
+    """
+    if geometry.isEmpty():
+        return []
+    wkb = bytes(geometry.asWkb())
+
+    def read_polygon(offset):
+        order = '<' if wkb[offset] == 1 else '>'
+        count, = struct.unpack_from(order + 'I', wkb, offset + 5)
+        offset += 9
+        rings = []
+        for i in range(count):
+            length, = struct.unpack_from(order + 'I', wkb, offset)
+            ring = np.frombuffer(wkb, dtype=order + 'f8', count=2*length,
+                                 offset=offset + 4).reshape(-1, 2)
+            rings.append(ring[:-1])
+            offset += 4 + 16*length
+        return rings, offset
+
+    order = '<' if wkb[0] == 1 else '>'
+    wkb_type, = struct.unpack_from(order + 'I', wkb, 1)
+    if wkb_type == 3:
+        return [read_polygon(0)[0]]
+    if wkb_type != 6:
+        raise ValueError('Unsupported WKB type {}'.format(wkb_type))
+
+    count, = struct.unpack_from(order + 'I', wkb, 5)
+    polygons = []
+    offset = 9
+    for i in range(count):
+        rings, offset = read_polygon(offset)
+        polygons.append(rings)
+    return polygons
+
+
+def project_rings(polygons, project):
+    """Reproject the rings of a list of polygons in a single call.
+
+    Args:
+        polygons: A list of lists of numpy arrays of shape (n, 2), as returned
+            by polygon_rings.
+        project: A callable transforming a numpy array of shape (n, 2).
+
+    Returns:
+        A list of lists of numpy arrays of shape (n, 2), with the same
+        structure as polygons.
+    """
+    rings = [ring for polygon in polygons for ring in polygon]
+    if not rings:
+        return []
+    lengths = [len(ring) for ring in rings]
+    projected = project(np.vstack(rings))
+    pieces = iter(np.split(projected, np.cumsum(lengths)[:-1]))
+    return [[next(pieces) for ring in polygon] for polygon in polygons]
+
+
+def multilinestring_from_vertices(lines):
+    """Build a multilinestring geometry from a list of arrays of vertices in
+    a single call.
+
+    Args:
+        lines: A list of numpy arrays of shape (n, 2), each containing the
+            vertices of a part.
+
+    Returns:
+        A QgsGeometry (of type QgsWkbTypes.LineGeometry) with one part per
+        array.
+    """
+    chunks = [struct.pack('<BII', 1, 5, len(lines))]
+    for vertices in lines:
+        chunks.append(struct.pack('<BII', 1, 2, len(vertices)))
+        chunks.append(np.ascontiguousarray(vertices, dtype='<f8').tobytes())
+
+    geometry = QgsGeometry()
+    geometry.fromWkb(b''.join(chunks))
+    return geometry
+
+
+def swept_hull(previous, current):
+    """Compute the area swept by a convex brush shape between two samples.
+
+    The swept area of a convex shape moving in a straight line is the convex
+    hull of its two positions, which is computed here with Andrew's monotone
+    chain algorithm instead of GEOS.
+
+    Args:
+        previous: A numpy array of shape (n, 2) containing the vertices of
+            the brush at the previous sample.
+        current: A numpy array of shape (n, 2) containing the vertices of the
+            brush at the current sample.
+
+    Returns:
+        A numpy array of shape (m, 2) containing the vertices of the hull in
+        counterclockwise order (without the closing vertex).
+    """
+    points = sorted(map(tuple, np.vstack((previous, current)).tolist()))
+
+    def half_hull(points):
+        hull = []
+        for p in points:
+            while len(hull) >= 2 and _cross(hull[-2], hull[-1], p) <= 0:
+                hull.pop()
+            hull.append(p)
+        return hull
+
+    lower = half_hull(points)
+    upper = half_hull(reversed(points))
+    return np.array(lower[:-1] + upper[:-1])
+
+
+def simplify_indices(vertices, tolerance):
+    """Simplify a polyline with the Douglas-Peucker algorithm.
+
+    Distances are measured to the simplified segments rather than to their
+    supporting lines, so samples where the brush turned back are kept.
+
+    Args:
+        vertices: A numpy array of shape (n, 2) containing the vertices of the
+            polyline.
+        tolerance: A float representing the maximum distance between the
+            polyline and its simplification.
+
+    Returns:
+        A sorted numpy array of the indices of the vertices to keep. The first
+        and last vertices are always kept.
+    """
+    n = len(vertices)
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, n - 1]] = True
+
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        segment = vertices[last] - vertices[first]
+        offsets = vertices[first + 1:last] - vertices[first]
+        length = segment @ segment
+        if length:
+            t = np.clip(offsets @ segment / length, 0, 1)
+            offsets = offsets - t[:, None] * segment
+        distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            stack += [(first, middle), (middle, last)]
+
+    return np.flatnonzero(keep)
+
+
+def _cross(o, a, b):
+    """Return the z component of the cross product of the vectors o->a and
+    o->b."""
+    return (a[0] - o[0])*(b[1] - o[1]) - (a[1] - o[1])*(b[0] - o[0])
+
+
+class StrokeAccumulator:
+    """Record the samples of a brush stroke and build its polygon on demand.
+
+    Circular brushes are recorded as a centreline which is buffered in a
+    single pass. All other brushes are recorded as the swept shapes between
+    consecutive samples (see swept_hull), which are unioned in a single
+    cascaded union.
+
+    If the stroke has to end up in another CRS, the swept shapes are
+    reprojected in batches while the stroke is drawn (see project_pending),
+    so that they are assembled directly in the target CRS. The centreline is
+    buffered in map coordinates and only the outline of the buffer is
+    reprojected, since a single radius in the target CRS does not hold for
+    transforms that stretch one direction more than the other (such as a
+    geographic layer on a Web Mercator canvas).
+
+    If a tolerance is given, the part of the stroke that is no longer
+    changing is simplified while the stroke is drawn (see settle), so that the
+    number of stored vertices stays within vertex_budget however long the
+    stroke is.
+
+    Attributes:
+        radius: A float representing the brush radius in map units.
+        segments: An integer number of segments per quarter circle to use
+            when buffering the centreline.
+        project: A callable transforming a numpy array of shape (n, 2) from
+            map coordinates to the target CRS, or None if no reprojection is
+            necessary.
+        scale: A float by which distances in map units must be multiplied to
+            get distances in the target CRS, on average over all directions.
+        tolerance: A float representing the maximum distance in map units
+            between the recorded and the simplified samples. 0 disables
+            simplification.
+        settle_tolerance: A float representing the tolerance used for the
+            settled part of the stroke. Starts at tolerance and is doubled
+            whenever the vertex budget is exceeded, up to max_tolerance.
+        max_tolerance: A float representing the largest settle_tolerance
+            allowed, so that long strokes are never coarsened beyond a
+            fraction of the brush radius.
+        vertex_budget: An integer number of vertices above which the settled
+            part of the stroke is simplified with a larger tolerance.
+        settle_size: An integer number of new samples (or swept shapes) after
+            which they are simplified.
+        settled_geometry: A QgsGeometry in map coordinates of the swept brush
+            shapes that have already been unioned and simplified, or None.
+        projected_settled_geometry: The same geometry in the target CRS, or
+            None.
+        runs: A list of lists of (x, y) tuples in map coordinates making up
+            the stroke centreline. A new run is started whenever samples are
+            skipped.
+        polygons: A list of numpy arrays containing the vertices of the swept
+            brush shapes in map coordinates.
+        projected_polygons: A list of numpy arrays containing the reprojected
+            vertices of each swept brush shape.
+
+    Methods:
+        add_point: Append a sample to the stroke centreline.
+        skip_to: End the current run of the centreline and start a new one at
+            a given point.
+        add_polygon: Append a swept brush shape to the stroke.
+        is_empty: Check whether anything has been recorded.
+        has_pending: Check whether some swept shapes still have to be
+            reprojected.
+        project_pending: Reproject all the swept shapes recorded since the
+            last call in a single batch.
+        settle: Simplify the samples that are no longer changing.
+        vertex_count: Return the number of stored vertices.
+        settled_rings: Return the rings of settled_geometry.
+        geometry: Build the polygon covered by the stroke.
+    """
+
+    def __init__(self, radius, segments, project=None, scale=1, tolerance=0,
+                 vertex_budget=5000, settle_size=256, max_tolerance=None):
+        """Constructor for the stroke accumulator.
+
+        Args:
+            radius: A float representing the brush radius in map units.
+            segments: An integer number of segments per quarter circle.
+            project: An optional callable transforming a numpy array of shape
+                (n, 2) from map coordinates to the target CRS. Defaults to
+                None, which means that no reprojection is necessary.
+            scale: A float by which distances in map units must be multiplied
+                to get distances in the target CRS. Defaults to 1.
+            tolerance: A float representing the maximum distance in map units
+                between the recorded and the simplified samples. Defaults to
+                0, which disables simplification while drawing.
+            vertex_budget: An integer number of vertices above which the
+                stroke is simplified with a larger tolerance. Defaults to
+                5000.
+            settle_size: An integer number of new samples after which they
+                are simplified. Defaults to 256.
+            max_tolerance: A float representing the largest tolerance in map
+                units used to keep within the vertex budget. Defaults to None,
+                which means a quarter of the radius (or tolerance, if larger).
+        """
+        self.radius = radius
+        self.segments = segments
+        self.project = project
+        self.scale = scale
+        self.runs = []
+        self.polygons = []
+        self.skipping = False
+
+        self.tolerance = tolerance
+        self.settle_tolerance = tolerance
+        if max_tolerance is None:
+            max_tolerance = max(tolerance, radius / 4)
+        self.max_tolerance = max_tolerance
+        self.vertex_budget = vertex_budget
+        self.settle_size = settle_size
+        self.settled_geometry = None
+        self.projected_settled_geometry = None
+        self._settled_samples = 0
+
+        self.projected_polygons = []
+
+    def add_point(self, point):
+        """Append a sample to the stroke centreline.
+
+        Args:
+            point: A QgsPointXY indicating the position of the brush.
+        """
+        if not self.runs:
+            self.runs.append([])
+        self.runs[-1].append((point.x(), point.y()))
+        self.skipping = False
+
+    def skip_to(self, point):
+        """End the current run of the centreline and start a new one.
+
+        To be called when the area swept by the brush between the last sample
+        and point is already covered by the stroke, so the next sample is
+        joined to point rather than to the last recorded sample.
+
+        Args:
+            point: A QgsPointXY indicating the position of the brush.
+        """
+        if self.skipping:
+            self.runs[-1] = [(point.x(), point.y())]
+        else:
+            self.runs.append([(point.x(), point.y())])
+        self._settled_samples = 0
+        self.skipping = True
+
+    def add_polygon(self, vertices):
+        """Append a swept brush shape to the stroke.
+
+        Args:
+            vertices: A numpy array of shape (n, 2) containing the vertices of
+                the area covered by the brush since the previous sample.
+        """
+        self.polygons.append(vertices)
+
+    def is_empty(self):
+        """Return True if no sample has been recorded yet."""
+        return (not self.runs and not self.polygons and
+                self.settled_geometry is None)
+
+    def has_pending(self):
+        """Return True if some swept shapes still have to be reprojected."""
+        if self.project is None:
+            return False
+        return len(self.projected_polygons) < len(self.polygons)
+
+    def project_pending(self):
+        """Reproject all the swept shapes recorded since the last call in a
+        single call to self.project."""
+        if not self.has_pending():
+            return
+
+        new_polygons = self.polygons[len(self.projected_polygons):]
+        lengths = [len(polygon) for polygon in new_polygons]
+        projected = self.project(np.vstack(new_polygons))
+        self.projected_polygons.extend(
+            np.split(projected, np.cumsum(lengths)[:-1]))
+
+    def settle(self):
+        """Simplify the samples that are no longer changing.
+
+        Once settle_size new samples have been added to the current run, all
+        but its last sample are simplified. Once settle_size swept shapes have
+        been added, they are unioned into settled_geometry and simplified. If
+        the stroke then holds more than vertex_budget vertices,
+        settle_tolerance is doubled (up to max_tolerance) and everything is
+        simplified again. The budget may be exceeded once max_tolerance is
+        reached, rather than coarsening the stroke beyond it.
+
+        Returns:
+            True if the stored samples changed, in which case any preview of
+            the stroke should be rebuilt.
+        """
+        if not self.tolerance:
+            return False
+
+        settle_run = (self.runs and
+                      len(self.runs[-1]) - self._settled_samples >= self.settle_size)
+        settle_polygons = len(self.polygons) >= self.settle_size
+        if not settle_run and not settle_polygons:
+            return False
+
+        # Simplification must keep the reprojected swept shapes in step
+        self.project_pending()
+
+        if settle_run:
+            last = len(self.runs[-1]) - 1
+            self._simplify_run(len(self.runs) - 1,
+                               max(0, self._settled_samples - 1), last,
+                               self.settle_tolerance)
+            self._settled_samples = len(self.runs[-1]) - 1
+        if settle_polygons:
+            self._merge_polygons()
+
+        # Enforce the vertex budget
+        while (self.vertex_count() > self.vertex_budget and
+               self.settle_tolerance < self.max_tolerance):
+            self.settle_tolerance = min(2 * self.settle_tolerance,
+                                        self.max_tolerance)
+            for i, run in enumerate(self.runs):
+                self._simplify_run(i, 0, len(run) - 1, self.settle_tolerance)
+            self._merge_polygons()
+        self._settled_samples = len(self.runs[-1]) - 1 if self.runs else 0
+
+        return True
+
+    def vertex_count(self):
+        """Return the number of vertices stored for the stroke."""
+        count = sum(len(run) for run in self.runs)
+        count += sum(len(polygon) for polygon in self.polygons)
+        if self.settled_geometry is not None:
+            count += self.settled_geometry.constGet().nCoordinates()
+        return count
+
+    def settled_rings(self):
+        """Return the rings of settled_geometry in map coordinates.
+
+        Returns:
+            A list of numpy arrays of shape (n, 2), one per exterior ring or
+            hole.
+        """
+        if self.settled_geometry is None:
+            return []
+        return [ring for polygon in polygon_rings(self.settled_geometry)
+                for ring in polygon]
+
+    def geometry(self):
+        """Build the polygon covered by the stroke.
+
+        Returns:
+            A QgsGeometry (of type QgsWkbTypes.PolygonGeometry) covering every
+            recorded sample, in the target CRS if self.project is set, or an
+            empty QgsGeometry if nothing was recorded.
+        """
+        runs = [np.array(run) for run in self.runs if run]
+        if self.project is None:
+            polygons = self.polygons
+            settled = self.settled_geometry
+        else:
+            self.project_pending()
+            polygons = self.projected_polygons
+            settled = self.projected_settled_geometry
+
+        parts = []
+
+        if settled is not None:
+            parts.append(settled)
+
+        if polygons:
+            parts.append(multipolygon_from_vertices(polygons))
+
+        if runs:
+            # A single sample is a zero-length line, which buffers to a circle
+            lines = [run if len(run) > 1 else np.vstack((run, run))
+                     for run in runs]
+            centreline = multilinestring_from_vertices(lines)
+            buffered = centreline.buffer(self.radius, self.segments)
+            if self.project is not None:
+                buffered = multipolygon_from_rings(
+                    project_rings(polygon_rings(buffered), self.project))
+            parts.append(buffered)
+
+        if not parts:
+            return QgsGeometry()
+        if len(parts) == 1 and not polygons:
+            return parts[0]
+        return QgsGeometry.unaryUnion(parts)
+
+    def _simplify_run(self, i, first, last, tolerance):
+        """Simplify the samples first to last (included) of run i."""
+        run = self.runs[i]
+        if last - first < 2:
+            return
+        keep = simplify_indices(np.array(run[first:last + 1]), tolerance) + first
+        self.runs[i] = run[:first] + [run[k] for k in keep] + run[last + 1:]
+
+    def _merge_polygons(self):
+        """Union the swept brush shapes into settled_geometry and simplify it,
+        along with the matching reprojected geometry."""
+        self.settled_geometry = _merge(self.settled_geometry, self.polygons,
+                                       self.settle_tolerance)
+        if self.project is not None:
+            self.projected_settled_geometry = _merge(
+                self.projected_settled_geometry, self.projected_polygons,
+                self.settle_tolerance * self.scale)
+        self.polygons = []
+        self.projected_polygons = []
+
+
+def _merge(geometry, polygons, tolerance):
+    """Union a geometry (or None) with a list of arrays of polygon vertices,
+    and simplify the result.
+
+    Simplification does not preserve topology, so the union is kept as it is
+    if simplifying it makes it invalid or empty, rather than feeding a broken
+    geometry to the next union."""
+    parts = [geometry] if geometry is not None else []
+    if polygons:
+        parts.append(multipolygon_from_vertices(polygons))
+    if not parts:
+        return None
+    union = QgsGeometry.unaryUnion(parts)
+    simplified = union.simplify(tolerance)
+    if simplified.isEmpty() or not simplified.isGeosValid():
+        return union
+    return simplified
+
+
+class StrokeSampler:
+    """Decide which mouse moves are far enough apart to be recorded.
+
+    Positions are compared in screen pixels, so the sampling density follows
+    what the user sees rather than the map scale.
+
+    Attributes:
+        spacing: A float representing the minimum distance in pixels between
+            two kept samples.
+        received: An integer counting the moves passed to accept.
+        kept: An integer counting the moves that were actually recorded.
+
+    Methods:
+        start: Start sampling a new stroke at a given position.
+        accept: Check whether a move is far enough from the last sample.
+        keep: Count a move as recorded.
+        keep_ratio: Return the fraction of received moves that were kept.
+        reset_statistics: Reset the move counters.
+    """
+
+    def __init__(self, spacing=1):
+        """Constructor for the stroke sampler.
+
+        Args:
+            spacing: A float representing the minimum distance in pixels
+                between two kept samples. Defaults to 1.
+        """
+        self.spacing = spacing
+        self.last_position = None
+        self.reset_statistics()
+
+    def start(self, x, y):
+        """Start sampling a new stroke at a given position in pixels."""
+        self.last_position = (x, y)
+
+    def accept(self, x, y):
+        """Check whether a move is far enough from the last sample.
+
+        Args:
+            x: A number representing the horizontal position in pixels.
+            y: A number representing the vertical position in pixels.
+
+        Returns:
+            True if the move is at least self.spacing pixels away from the last
+            accepted position, in which case it becomes the last position.
+        """
+        self.received += 1
+        if self.last_position is not None:
+            dx = x - self.last_position[0]
+            dy = y - self.last_position[1]
+            if dx*dx + dy*dy < self.spacing*self.spacing:
+                return False
+        self.last_position = (x, y)
+        return True
+
+    def keep(self):
+        """Count a move as recorded."""
+        self.kept += 1
+
+    def keep_ratio(self):
+        """Return the fraction of received moves that were recorded."""
+        if not self.received:
+            return 1.0
+        return self.kept / self.received
+
+    def reset_statistics(self):
+        """Reset the move counters."""
+        self.received = 0
+        self.kept = 0
+
+
+class CoverageGrid:
+    """Screen-space record of the area already covered by a stroke.
+
+    The grid stores, for the center of each cell, how deep inside the covered
+    area it lies (its clearance, in pixels). The clearance cannot change by
+    more than the distance travelled, so the whole cell is covered if its
+    center lies deeper than half a cell diagonal. This makes covers
+    conservative: it never reports an area as covered when it is not.
+
+    Attributes:
+        cell_size: A float representing the size of a cell in pixels.
+        clearance: A dict mapping the (column, row) of each cell deep enough
+            inside the covered area to the clearance of its center.
+
+    Methods:
+        mark: Record the area swept by a brush as covered.
+        covers: Check whether the area swept by a brush is already covered.
+    """
+
+    def __init__(self, cell_size):
+        """Constructor for the coverage grid.
+
+        Args:
+            cell_size: A float representing the size of a cell in pixels.
+        """
+        self.cell_size = max(1.0, float(cell_size))
+        self.margin = self.cell_size * sqrt(2) / 2
+        self.clearance = {}
+
+    def mark(self, x0, y0, x1, y1, radius):
+        """Record the area swept by a circle moving along a segment as
+        covered.
+
+        Args:
+            x0, y0: Numbers representing the start of the segment in pixels.
+            x1, y1: Numbers representing the end of the segment in pixels.
+            radius: A number representing the radius of the circle in pixels.
+        """
+        for cell, center in self._cells(x0, y0, x1, y1, radius):
+            depth = radius - _segment_distance(center, x0, y0, x1, y1)
+            if depth >= self.margin and depth > self.clearance.get(cell, 0):
+                self.clearance[cell] = depth
+
+    def covers(self, x0, y0, x1, y1, radius):
+        """Check whether the area swept by a circle moving along a segment is
+        entirely covered.
+
+        Args:
+            x0, y0: Numbers representing the start of the segment in pixels.
+            x1, y1: Numbers representing the end of the segment in pixels.
+            radius: A number representing the radius of the circle in pixels.
+
+        Returns:
+            True if every point of the swept area is covered.
+        """
+        reach = radius + self.margin
+        for cell, center in self._cells(x0, y0, x1, y1, reach):
+            if cell in self.clearance:
+                continue
+            if _segment_distance(center, x0, y0, x1, y1) <= reach:
+                return False
+        return True
+
+    def _cells(self, x0, y0, x1, y1, radius):
+        """Yield the index and center of every cell in the bounding box of a
+        swept circle."""
+        size = self.cell_size
+        columns = range(floor((min(x0, x1) - radius) / size),
+                        floor((max(x0, x1) + radius) / size) + 1)
+        rows = range(floor((min(y0, y1) - radius) / size),
+                     floor((max(y0, y1) + radius) / size) + 1)
+        for i in columns:
+            for j in rows:
+                yield (i, j), ((i + 0.5) * size, (j + 0.5) * size)
+
+
+def _segment_distance(point, x0, y0, x1, y1):
+    """Return the distance from a point to a segment."""
+    px, py = point
+    dx, dy = x1 - x0, y1 - y0
+    length = dx*dx + dy*dy
+    if length:
+        t = max(0.0, min(1.0, ((px - x0)*dx + (py - y0)*dy) / length))
+        x0, y0 = x0 + t*dx, y0 + t*dy
+    return sqrt((px - x0)**2 + (py - y0)**2)
@@ -0,0 +1,139 @@
+import sys
+import os
+import types
+
+import numpy as np
+
+# Stub out every Qt and QGIS module imported by brushtools, without leaking
+# them into the other test modules. Any name taken from a stub module is an
+# empty class.
+def stub_module(name):
+    module = types.ModuleType(name)
+
+    def __getattr__(attr):
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        cls = type(attr, (), {"__init__": lambda self, *args, **kwargs: None})
+        setattr(module, attr, cls)
+        return cls
+
+    module.__getattr__ = __getattr__
+    return module
+
+
+root = os.path.dirname(os.path.dirname(__file__))
+
+pkg = types.ModuleType("class_labeler")
+pkg.__path__ = [root]
+stubs = {name: stub_module(name) for name in [
+    "qgis", "qgis.gui", "qgis.core", "qgis.PyQt", "qgis.PyQt.QtCore",
+    "qgis.PyQt.QtGui", "qgis.PyQt.QtWidgets", "PyQt5", "PyQt5.QtGui"]}
+stubs["class_labeler"] = pkg
+modules = ["brushtools", "brushitems", "connections", "reprojection",
+           "strokemask", "strokes"]
+saved = {name: sys.modules.get(name) for name in stubs}
+saved.update({"class_labeler." + name: sys.modules.get("class_labeler." + name)
+              for name in modules})
+sys.modules.update(stubs)
+
+import importlib.util
+
+
+def load(name):
+    spec = importlib.util.spec_from_file_location(
+        "class_labeler." + name, os.path.join(root, name + ".py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+try:
+    brushtools = load("brushtools")
+finally:
+    for name, module in saved.items():
+        if module is None:
+            sys.modules.pop(name, None)
+        else:
+            sys.modules[name] = module
+
+
+def idle_tool(**attributes):
+    """Create a BrushTool without a canvas, with only the attributes the
+    tested methods need."""
+    tool = object.__new__(brushtools.BrushTool)
+    idle = types.SimpleNamespace(stop=lambda: None, reset=lambda: None)
+    tool.__dict__.update(
+        brush_shapes=['circle', 'wedge', 'rectangle'], brush_shape='circle',
+        brush_radius=10, brush_angle=0, pending_shape_switches=0, stroke=None,
+        flush_timer=idle, projection_timer=idle, preview=idle,
+        make_cursor=lambda *args: None)
+    tool.__dict__.update(attributes)
+    return tool
+
+
+def test_shape_switch_mid_stroke_is_applied_on_reset():
+    tool = idle_tool(stroke=object())
+
+    tool.switch_brush_shape()
+    tool.switch_brush_shape()
+    assert tool.brush_shape == 'circle'
+
+    tool.reset()
+    assert tool.brush_shape == 'rectangle'
+    assert tool.pending_shape_switches == 0
+
+    tool.switch_brush_shape()
+    assert tool.brush_shape == 'circle'
+
+
+class Position:
+    def __init__(self, x, y):
+        self._x, self._y = x, y
+
+    def x(self):
+        return self._x
+
+    def y(self):
+        return self._y
+
+
+def test_resizing_mid_stroke_does_not_grow_the_painted_area():
+    recorded = []
+    stroke = types.SimpleNamespace(add_point=recorded.append, skip_to=recorded.append,
+                                   settle=lambda: False)
+    coverage = brushtools.CoverageGrid(10 / 4)
+    coverage.mark(0, 0, 0, 0, 10)
+    tool = idle_tool(
+        stroke=stroke, coverage=coverage, coverage_skips=0,
+        stroke_radius=10, stroke_painted_radius=10, recorded_position=Position(0, 0),
+        sampler=types.SimpleNamespace(keep=lambda: None), reprojecting=False,
+        toMapCoordinates=lambda position: position,
+        preview=types.SimpleNamespace(add_point=lambda point: None))
+
+    # Shift+wheel mid-stroke grows the brush, but not the stroke
+    tool.brush_radius = 50
+    tool.record_move(Position(40, 0))
+
+    assert max(coverage.clearance.values()) <= 10
+    # Scrubbing back over ground the 10 pixel stroke never reached is kept
+    assert not coverage.covers(40, 0, 40, 20, 10)
+
+
+def test_geometry_helpers_read_the_cached_scale():
+    reads = []
+
+    class MapSettings:
+        def mapUnitsPerPixel(self):
+            reads.append(True)
+            return 0.5
+
+    tool = idle_tool(canvas=types.SimpleNamespace(mapSettings=MapSettings),
+                     scale_cache_refreshes=0, brush_points=9)
+    tool.update_scale_cache()
+
+    for x in range(10):
+        vertices = tool.vertices_around_point('rectangle', Position(x, 0))
+
+    assert len(reads) == tool.scale_cache_refreshes == 1
+    assert np.allclose(np.hypot(vertices[:, 0] - 9, vertices[:, 1]), 5)
@@ -0,0 +1,52 @@
+import os
+import importlib.util
+
+root = os.path.dirname(os.path.dirname(__file__))
+spec = importlib.util.spec_from_file_location("class_labeler.connections", os.path.join(root, "connections.py"))
+connections = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(connections)
+
+
+class Signal:
+    def __init__(self):
+        self.slots = []
+
+    def connect(self, slot):
+        self.slots.append(slot)
+
+    def disconnect(self, slot):
+        self.slots.remove(slot)
+
+
+class Layer:
+    def __init__(self):
+        self.editingStarted = Signal()
+        self.editingStopped = Signal()
+
+
+class Plugin:
+    def check(self):
+        pass
+
+
+def test_connect_is_idempotent_and_disconnects_by_owner_and_sender():
+    registry = connections.ConnectionRegistry()
+    plugin, other = Plugin(), Plugin()
+    first, second = Layer(), Layer()
+
+    for _ in range(3):
+        for layer in (first, second, first):
+            registry.connect(layer, "editingStarted", plugin.check, owner=plugin)
+    registry.connect(first, "editingStopped", other.check, owner=other)
+
+    assert first.editingStarted.slots == [plugin.check]
+    assert registry.count(plugin) == 2
+
+    assert registry.disconnect(owner=plugin, sender=first) == 1
+    assert first.editingStarted.slots == []
+    assert second.editingStarted.slots == [plugin.check]
+    assert first.editingStopped.slots == [other.check]
+
+    registry.disconnect()
+    assert registry.count() == 0
+    assert second.editingStarted.slots == first.editingStopped.slots == []
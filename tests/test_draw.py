@@ -30,6 +30,15 @@ for name in [
     "QgsLayerTreeGroup",
     "QgsWkbTypes",
     "QgsMapLayer",
+    "QgsFeatureRequest",
+    "QgsSimplifyMethod",
+    "QgsRectangle",
+    "QgsExpression",
+    "QgsExpressionContext",
+    "QgsApplication",
+    "QgsSpatialIndex",
+    "QgsTask",
+    "QgsVectorLayerFeatureSource",
 ]:
     setattr(core, name, type(name, (), {}))
 
@@ -101,3 +110,307 @@ def test_draw_requires_edit_mode():
 
     assert warnings, "Expected warning when layer is not editable"
     assert not layer.start_called, "startEditing should not be invoked"
+
+
+def test_activate_reuses_a_single_brush_tool(monkeypatch):
+    created = []
+
+    class Signal:
+        def __init__(self):
+            self.slots = []
+
+        def connect(self, slot):
+            self.slots.append(slot)
+
+    class FakeBrushTool:
+        instances = created
+
+        def __init__(self, iface, connections):
+            self.rb_finished = Signal()
+            created.append(self)
+
+        def setAction(self, action):
+            self.action = action
+
+    class Canvas:
+        def setMapTool(self, tool):
+            self.tool = tool
+
+    canvas = Canvas()
+    iface = types.SimpleNamespace(mapCanvas=lambda: canvas)
+    status_bar = types.SimpleNamespace(showMessage=lambda message: None)
+    plugin = types.SimpleNamespace(
+        iface=iface, tool=None, activations=0, pluginIsActive=False,
+        actions=["brush action"], active_layer="layer", sb=status_bar,
+        status_tip="", draw=lambda geometry: None,
+        connections=drawmybrush.ConnectionRegistry())
+
+    monkeypatch.setattr(drawmybrush, "BrushTool", FakeBrushTool)
+    for _ in range(3):
+        drawmybrush.DrawByBrush.activate_brush_tool(plugin)
+
+    assert len(created) == 1
+    assert len(created[0].rb_finished.slots) == 1
+    assert canvas.tool is created[0]
+    assert plugin.activations == 3
+
+
+def test_relation_from_matrix():
+    relation = drawmybrush.relation_from_matrix
+    # Stroke covering a feature, and both equal
+    assert relation("212FF1FF2") == "contains"
+    assert relation("2FFF1FFF2") == "contains"
+    # Stroke inside a feature
+    assert relation("2FF1FF212") == "contained_by"
+    # Interiors partly overlapping
+    assert relation("212101212") == "partial_overlap"
+    # Touching or disjoint
+    assert relation("FF2F11212") is None
+    assert relation("FF2FF1212") is None
+
+
+def test_class_scoped_request_uses_index_candidates(monkeypatch):
+    class Request:
+        def __init__(self):
+            self.calls = {}
+
+        def __getattr__(self, name):
+            return lambda *args: self.calls.__setitem__(name, args)
+
+    class Expression:
+        @staticmethod
+        def createFieldEqualityExpression(field, value):
+            return f'"{field}" = \'{value}\''
+
+    class Fields:
+        def indexFromName(self, name):
+            return 2 if name == "landuse" else -1
+
+    class Provider:
+        def createAttributeIndex(self, idx):
+            raise AssertionError("the data source must not be modified")
+
+    class Layer:
+        def fields(self):
+            return Fields()
+
+        def dataProvider(self):
+            return Provider()
+
+    class Index:
+        fids = None
+
+        def candidates(self, rect):
+            return self.fids
+
+    monkeypatch.setattr(drawmybrush, "QgsFeatureRequest", Request)
+    monkeypatch.setattr(drawmybrush, "QgsExpression", Expression)
+    monkeypatch.setattr(drawmybrush, "QgsSimplifyMethod", lambda: None)
+
+    index = Index()
+    plugin = types.SimpleNamespace(
+        active_layer=Layer(), class_scoped=True, layer_index=lambda layer: index,
+        _get_class_field=lambda: "landuse", _get_class_value=lambda: "forest")
+    class_filter = drawmybrush.DrawByBrush.class_filter(plugin)
+    assert class_filter == (2, '"landuse" = \'forest\'')
+
+    # While the index is being built, the provider filters on both
+    request = drawmybrush.DrawByBrush.overlap_request(plugin, "bbox", class_filter)
+    assert request.calls["setFilterRect"] == ("bbox",)
+    assert request.calls["setFilterExpression"] == ('"landuse" = \'forest\'',)
+    assert request.calls["setSubsetOfAttributes"] == ([2],)
+    assert "setFilterFids" not in request.calls
+
+    # Then the candidates come from the index, with the class field fetched
+    index.fids = [4, 9]
+    request = drawmybrush.DrawByBrush.overlap_request(plugin, "bbox", class_filter)
+    assert request.calls["setFilterFids"] == ([4, 9],)
+    assert request.calls["setSubsetOfAttributes"] == ([2],)
+    assert "setFilterRect" not in request.calls
+
+
+class Cells:
+    """Polygon stand-in made of a set of grid cells."""
+
+    def __init__(self, cells):
+        self.cells = frozenset(cells)
+
+    def difference(self, other):
+        return Cells(self.cells - other.cells)
+
+    def isEmpty(self):
+        return not self.cells
+
+    def boundingBox(self):
+        return self.cells
+
+
+class CellsFactory:
+    @staticmethod
+    def unaryUnion(geometries):
+        return Cells(set().union(*(g.cells for g in geometries)))
+
+
+class CellsFeature:
+    def __init__(self, fields):
+        self.geom = None
+
+    def setGeometry(self, geometry):
+        self.geom = geometry
+
+    def geometry(self):
+        return self.geom
+
+
+class EditLayer:
+    def __init__(self):
+        self.added = []
+        self.changed = {}
+        self.deleted = []
+        self.commands = []
+
+    def isEditable(self):
+        return True
+
+    def fields(self):
+        return types.SimpleNamespace(indexFromName=lambda name: -1)
+
+    def beginEditCommand(self, text):
+        self.commands.append(text)
+
+    def endEditCommand(self):
+        pass
+
+    def changeGeometry(self, fid, geometry):
+        self.changed[fid] = geometry.cells
+
+    def deleteFeatures(self, fids):
+        self.deleted.extend(fids)
+
+    def addFeature(self, feature):
+        self.added.append(feature.geometry().cells)
+        return True
+
+    def triggerRepaint(self):
+        pass
+
+
+def coverage_plugin(monkeypatch, layer, paint_mode, existing, classes=None,
+                    merging=False):
+    """Build a DrawByBrush stand-in over cell geometries, recording the
+    scope of every overlap query."""
+    monkeypatch.setattr(drawmybrush, "QgsFeature", CellsFeature)
+    monkeypatch.setattr(drawmybrush, "QgsGeometry", CellsFactory)
+    scopes = []
+
+    def features_overlapping_with(feature, scoped=True, exclude=()):
+        scopes.append(scoped)
+        hits = [fid for fid, g in existing.items()
+                if g.cells & feature.geometry().cells and fid not in exclude
+                and (not scoped or classes is None or classes[fid] == "forest")]
+        return {'contains': [], 'contained_by': [], 'partial_overlap': hits,
+                'any_overlap': hits, 'geometry': existing}
+
+    plugin = types.SimpleNamespace(
+        tool=types.SimpleNamespace(active_layer=layer, drawing_mode="drawing",
+                                   merging=merging, reset=lambda: None),
+        iface=None, paint_mode=paint_mode, dirty_extent=None, scopes=scopes,
+        _get_class_field=None, _get_class_value=None,
+        features_overlapping_with=features_overlapping_with)
+    plugin.erased_geometries = lambda geometry, overlapping: \
+        drawmybrush.DrawByBrush.erased_geometries(plugin, geometry, overlapping)
+    plugin.mark_dirty = lambda rect: setattr(plugin, "dirty_extent", rect)
+    plugin.dirty_extent_visible = lambda: plugin.dirty_extent is not None
+    return plugin
+
+
+def test_fill_mode_clips_stroke_to_uncovered_area(monkeypatch):
+    layer = EditLayer()
+    plugin = coverage_plugin(monkeypatch, layer, "fill",
+                             {7: Cells({1, 2}), 8: Cells({5})})
+
+    drawmybrush.DrawByBrush.draw(plugin, Cells({1, 2, 3}))
+    drawmybrush.DrawByBrush.draw(plugin, Cells({1, 5}))
+
+    assert plugin.scopes == [False, False]
+    assert layer.added == [frozenset({3})]
+    assert layer.commands == ["Brush add"]
+    assert plugin.dirty_extent is None
+
+
+def test_class_scoped_merge_is_kept_overlap_free(monkeypatch):
+    layer = EditLayer()
+    plugin = coverage_plugin(monkeypatch, layer, "replace",
+                             {7: Cells({1, 2}), 8: Cells({3, 4})},
+                             classes={7: "forest", 8: "water"}, merging=True)
+
+    drawmybrush.DrawByBrush.draw(plugin, Cells({2, 3}))
+
+    # The stroke merges with the forest feature only, and the merged
+    # geometry is then erased from the water feature it overlaps
+    assert plugin.scopes == [True, False]
+    assert layer.deleted == [7]
+    assert layer.changed == {8: frozenset({4})}
+    assert layer.added == [frozenset({1, 2, 3})]
+    assert layer.commands == ["Brush add"]
+
+
+def test_repaint_only_when_the_changed_extent_is_visible():
+    class Extent:
+        def __init__(self, xmin, xmax):
+            self.xmin, self.xmax = xmin, xmax
+
+        def intersects(self, other):
+            return self.xmin <= other.xmax and other.xmin <= self.xmax
+
+    class MapSettings:
+        def layerExtentToOutputExtent(self, layer, extent):
+            # The layer CRS is in kilometres, the map CRS in metres
+            return Extent(extent.xmin * 1000, extent.xmax * 1000)
+
+    class Canvas:
+        def mapSettings(self):
+            return MapSettings()
+
+        def extent(self):
+            return Extent(0, 500)
+
+    plugin = types.SimpleNamespace(
+        iface=types.SimpleNamespace(mapCanvas=Canvas), active_layer=None,
+        dirty_extent=None)
+    visible = lambda: drawmybrush.DrawByBrush.dirty_extent_visible(plugin)
+
+    assert not visible()
+    plugin.dirty_extent = Extent(0.4, 0.6)
+    assert visible()
+    plugin.dirty_extent = Extent(0.6, 0.8)
+    assert not visible()
+
+
+def test_layer_indexes_are_kept_for_the_most_recent_layers(monkeypatch):
+    from collections import OrderedDict
+    built, released = [], []
+
+    class LayerIndex:
+        def __init__(self, layer, connections):
+            self.layer = layer
+            built.append(layer.id())
+
+        def release(self):
+            released.append(self.layer.id())
+            self.layer = None
+
+    monkeypatch.setattr(drawmybrush, "LayerIndex", LayerIndex)
+    layers = {name: types.SimpleNamespace(id=lambda name=name: name)
+              for name in "abc"}
+    plugin = types.SimpleNamespace(layer_indexes=OrderedDict(),
+                                   max_layer_indexes=2, connections=None)
+
+    for name in "ababcb":
+        drawmybrush.DrawByBrush.layer_index(plugin, layers[name])
+
+    # Switching back and forth does not index again, and the least recently
+    # used index is released once the limit is reached
+    assert built == ["a", "b", "c"]
+    assert released == ["a"]
+    assert list(plugin.layer_indexes) == ["c", "b"]
@@ -0,0 +1,200 @@
+import sys
+import os
+import types
+
+# Stub out the QGIS classes used by layerindex, without leaking them into the
+# other test modules
+qgis = types.ModuleType("qgis")
+core = types.ModuleType("qgis.core")
+qgis.core = core
+
+
+class Rect:
+    def __init__(self, xmin, ymin, xmax, ymax):
+        self.box = (xmin, ymin, xmax, ymax)
+
+    def xMinimum(self):
+        return self.box[0]
+
+    def yMinimum(self):
+        return self.box[1]
+
+    def xMaximum(self):
+        return self.box[2]
+
+    def yMaximum(self):
+        return self.box[3]
+
+    def intersects(self, other):
+        a, b = self.box, other.box
+        return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+    def __eq__(self, other):
+        return self.box == other.box
+
+
+class Geometry:
+    def __init__(self, rect):
+        self.rect = rect
+
+    @staticmethod
+    def fromRect(rect):
+        return Geometry(rect)
+
+    def boundingBox(self):
+        return self.rect
+
+    def isNull(self):
+        return self.rect is None
+
+
+class Feature:
+    def __init__(self, fid, geometry=None):
+        self._id = fid
+        self._geometry = geometry
+
+    def id(self):
+        return self._id
+
+    def setGeometry(self, geometry):
+        self._geometry = geometry
+
+    def geometry(self):
+        return self._geometry
+
+    def hasGeometry(self):
+        return self._geometry is not None
+
+
+class SpatialIndex:
+    def __init__(self):
+        self.entries = []
+
+    def addFeature(self, fid, rect):
+        self.entries.append((fid, rect))
+
+    def deleteFeature(self, feature):
+        self.entries.remove((feature.id(), feature.geometry().boundingBox()))
+
+    def intersects(self, rect):
+        return sorted(fid for fid, r in self.entries if r.intersects(rect))
+
+
+class Request:
+    def setNoAttributes(self):
+        return self
+
+
+class Task:
+    CanCancel = 1
+
+    def __init__(self, description, flags):
+        self.canceled = False
+
+    def isCanceled(self):
+        return self.canceled
+
+    def cancel(self):
+        self.canceled = True
+
+
+tasks = []
+core.QgsFeature = Feature
+core.QgsGeometry = Geometry
+core.QgsRectangle = Rect
+core.QgsSpatialIndex = SpatialIndex
+core.QgsFeatureRequest = Request
+core.QgsTask = Task
+core.QgsVectorLayerFeatureSource = lambda layer: layer
+core.QgsApplication = types.SimpleNamespace(
+    taskManager=lambda: types.SimpleNamespace(addTask=tasks.append))
+
+stubs = {"qgis": qgis, "qgis.core": core}
+saved = {name: sys.modules.get(name) for name in stubs}
+sys.modules.update(stubs)
+
+root = os.path.dirname(os.path.dirname(__file__))
+
+import importlib.util
+spec = importlib.util.spec_from_file_location("class_labeler.layerindex", os.path.join(root, "layerindex.py"))
+layerindex = importlib.util.module_from_spec(spec)
+try:
+    spec.loader.exec_module(layerindex)
+finally:
+    for name, module in saved.items():
+        if module is None:
+            sys.modules.pop(name, None)
+        else:
+            sys.modules[name] = module
+
+
+class Registry:
+    def connect(self, sender, signal, slot, owner=None):
+        pass
+
+    def disconnect(self, owner=None, sender=None):
+        pass
+
+
+class Layer:
+    def __init__(self, features, count=None):
+        self.features = features
+        self.count = count
+
+    def name(self):
+        return "parcels"
+
+    def featureCount(self):
+        return len(self.features) if self.count is None else self.count
+
+    def getFeatures(self, request):
+        return list(self.features.values())
+
+    def getFeature(self, fid):
+        return self.features[fid]
+
+
+def square(x):
+    return Geometry(Rect(x, 0, x + 1, 1))
+
+
+def test_edits_made_while_indexing_are_replayed():
+    layer = Layer({fid: Feature(fid, square(fid * 10)) for fid in (1, 2, 3)})
+    index = layerindex.LayerIndex(layer, Registry(), background_threshold=2)
+    assert not index.is_ready()
+    assert index.candidates(Rect(0, 0, 100, 1)) is None
+
+    # The task indexes a snapshot taken before these edits
+    task = tasks.pop()
+    del layer.features[1]
+    index.on_feature_deleted(1)
+    layer.features[-1] = Feature(-1, square(50))
+    index.on_feature_added(-1)
+    index.on_geometry_changed(2, square(60))
+
+    assert task.run()
+    task.finished(True)
+
+    assert index.is_ready()
+    assert index.candidates(Rect(0, 0, 100, 1)) == [-1, 2, 3]
+    assert index.candidates(Rect(15, 0, 25, 1)) == []
+    assert index.candidates(Rect(50, 0, 65, 1)) == [-1, 2]
+
+
+def test_small_layers_are_indexed_immediately_and_kept_in_step():
+    layer = Layer({fid: Feature(fid, square(fid * 10)) for fid in (1, 2)})
+    index = layerindex.LayerIndex(layer, Registry())
+    assert index.is_ready()
+
+    index.on_geometry_changed(1, square(20))
+    index.on_feature_deleted(2)
+    assert index.candidates(Rect(0, 0, 100, 1)) == [1]
+    assert index.bounds == {1: (20, 0, 21, 1)}
+
+
+def test_layers_of_unknown_size_are_indexed_in_the_background():
+    layer = Layer({1: Feature(1, square(0))}, count=-1)
+    index = layerindex.LayerIndex(layer, Registry())
+
+    assert not index.is_ready()
+    assert tasks.pop().run()
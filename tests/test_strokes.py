@@ -0,0 +1,408 @@
+import sys
+import os
+import struct
+import types
+
+import numpy as np
+import pytest
+
+# Stub out the QGIS modules required for importing strokes, without leaking
+# them into the other test modules
+qgis = types.ModuleType("qgis")
+core = types.ModuleType("qgis.core")
+qgis.core = core
+
+for name in ["QgsGeometry"]:
+    setattr(core, name, type(name, (), {}))
+core.QgsCsException = type("QgsCsException", (Exception,), {})
+core.QgsCoordinateTransform = lambda source, destination, project: (source, destination)
+core.QgsProject = types.SimpleNamespace(instance=lambda: None)
+
+stubs = {"qgis": qgis, "qgis.core": core}
+saved = {name: sys.modules.get(name) for name in stubs}
+sys.modules.update(stubs)
+
+# Now import the module under test
+root = os.path.dirname(os.path.dirname(__file__))
+
+import importlib.util
+
+
+def load(name):
+    spec = importlib.util.spec_from_file_location(
+        "class_labeler." + name, os.path.join(root, name + ".py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+pkg = types.ModuleType("class_labeler")
+pkg.__path__ = [root]
+stubs = {"class_labeler": pkg, "class_labeler.strokes": None,
+         "class_labeler.strokemask": None, "class_labeler.reprojection": None}
+saved.update({name: sys.modules.get(name) for name in stubs})
+sys.modules["class_labeler"] = pkg
+try:
+    strokes = load("strokes")
+    strokemask = load("strokemask")
+    reprojection = load("reprojection")
+finally:
+    for name, module in saved.items():
+        if module is None:
+            sys.modules.pop(name, None)
+        else:
+            sys.modules[name] = module
+
+
+def test_sampler_drops_moves_closer_than_spacing():
+    sampler = strokes.StrokeSampler(spacing=5)
+    sampler.start(0, 0)
+
+    assert not sampler.accept(3, 0)
+    assert not sampler.accept(3, 3)
+    assert sampler.accept(4, 4)
+    # Spacing is measured from the last accepted move, not the start
+    assert not sampler.accept(6, 6)
+    assert sampler.received == 4
+
+
+def test_sampler_keep_ratio():
+    sampler = strokes.StrokeSampler(spacing=10)
+    assert sampler.keep_ratio() == 1.0
+
+    sampler.start(0, 0)
+    for x in range(1, 41):
+        if sampler.accept(x, 0):
+            sampler.keep()
+
+    assert sampler.kept == 4
+    assert sampler.keep_ratio() == 4 / 40
+
+
+def test_coverage_grid_skips_only_painted_moves():
+    grid = strokes.CoverageGrid(cell_size=5)
+    grid.mark(0, 0, 100, 0, 20)
+
+    # Scrubbing back along the middle of the painted band is covered
+    assert grid.covers(60, 0, 40, 0, 10)
+    # Moving at full brush radius over the edge of the band is not
+    assert not grid.covers(60, 0, 40, 0, 20)
+    assert not grid.covers(100, 0, 120, 0, 10)
+
+
+class Point:
+    def __init__(self, x, y):
+        self._x, self._y = x, y
+
+    def x(self):
+        return self._x
+
+    def y(self):
+        return self._y
+
+
+def test_skip_to_starts_a_single_new_run():
+    stroke = strokes.StrokeAccumulator(1, 8)
+    stroke.add_point(Point(0, 0))
+    stroke.add_point(Point(1, 0))
+
+    stroke.skip_to(Point(2, 0))
+    stroke.skip_to(Point(3, 0))
+    stroke.add_point(Point(4, 0))
+
+    assert stroke.runs == [[(0, 0), (1, 0)], [(3, 0), (4, 0)]]
+
+
+def test_project_pending_reprojects_new_shapes_in_one_batch():
+    batches = []
+
+    def project(vertices):
+        batches.append(len(vertices))
+        return vertices * 2
+
+    triangle = np.array([[0.0, 0.0], [1.0, 0.0], [0.0, 1.0]])
+    stroke = strokes.StrokeAccumulator(1, 8, project=project)
+    stroke.add_point(Point(0, 0))
+    stroke.add_polygon(triangle)
+    stroke.project_pending()
+
+    stroke.add_polygon(triangle + 1)
+    stroke.add_polygon(triangle + 2)
+    stroke.project_pending()
+    stroke.project_pending()
+
+    assert batches == [3, 6]
+    assert not stroke.has_pending()
+    assert stroke.projected_polygons[0].tolist() == [[0, 0], [2, 0], [0, 2]]
+    assert stroke.projected_polygons[2].tolist() == [[4, 4], [6, 4], [4, 6]]
+
+
+def test_centreline_is_buffered_before_anisotropic_projection(monkeypatch):
+    class Buffered:
+        def isEmpty(self):
+            return False
+
+        def asWkb(self):
+            r = self.radius
+            ring = [-r, -r, r, -r, r, r, -r, r, -r, -r]
+            return struct.pack('<BIII10d', 1, 3, 1, 5, *ring)
+
+    class Centreline:
+        def buffer(self, radius, segments):
+            buffered = Buffered()
+            buffered.radius = radius
+            return buffered
+
+    built = []
+    monkeypatch.setattr(strokes, "multilinestring_from_vertices",
+                        lambda lines: Centreline())
+    monkeypatch.setattr(strokes, "multipolygon_from_rings",
+                        lambda polygons: built.append(polygons) or polygons)
+
+    # Twice as many layer units per map unit eastward as northward
+    def project(vertices):
+        return vertices * (2, 1)
+
+    stroke = strokes.StrokeAccumulator(1, 8, project=project, scale=2 ** 0.5)
+    stroke.add_point(Point(0, 0))
+    stroke.geometry()
+
+    # The circle is buffered with the map radius, then stretched into an
+    # ellipse, rather than buffered with an averaged radius in layer units
+    assert [ring.tolist() for ring in built[0][0]] == [
+        [[-2, -1], [2, -1], [2, 1], [-2, 1]]]
+
+
+def test_points_for_radius_follows_on_screen_size():
+    assert strokes.points_for_radius(5, 0.5) == 8
+    assert strokes.points_for_radius(120, 0.5) == 35
+    assert strokes.points_for_radius(1000, 0.5) > strokes.points_for_radius(120, 0.5)
+    assert strokes.points_for_radius(10 ** 6, 0.01) == 256
+
+
+def test_swept_hull_of_translated_square():
+    square = np.array([[1.0, 1.0], [-1.0, 1.0], [-1.0, -1.0], [1.0, -1.0]])
+    hull = strokes.swept_hull(square, square + (4, 4))
+
+    assert len(hull) == 6
+    assert {tuple(v) for v in hull} == {
+        (1, -1), (5, 3), (5, 5), (3, 5), (-1, 1), (-1, -1)}
+
+
+def test_simplify_indices_keeps_corners_within_tolerance():
+    xs = np.linspace(0, 10, 11)
+    line = np.column_stack((np.concatenate((xs, np.full(10, 10.0))),
+                            np.concatenate((np.zeros(11), xs[1:]))))
+    line[3, 1] = 0.05
+
+    assert strokes.simplify_indices(line, 0.1).tolist() == [0, 10, 20]
+    assert 3 in strokes.simplify_indices(line, 0.01)
+
+
+def test_settle_simplifies_the_settled_part_of_a_run():
+    stroke = strokes.StrokeAccumulator(1, 8, tolerance=0.1, settle_size=10)
+    for x in range(9):
+        stroke.add_point(Point(x, 0))
+    assert not stroke.settle()
+
+    stroke.add_point(Point(9, 1))
+    assert stroke.settle()
+    # The last sample is kept, since the run may still change after it
+    assert stroke.runs == [[(0, 0), (8, 0), (9, 1)]]
+
+
+def test_trace_contours_of_a_ring():
+    mask = np.ones((3, 3), dtype=bool)
+    mask[1, 1] = False
+    hole, exterior = sorted(strokemask.trace_contours(mask),
+                            key=strokemask.signed_area)
+
+    # Exterior ring is counterclockwise, the hole clockwise
+    assert strokemask.signed_area(hole) < 0 < strokemask.signed_area(exterior)
+    assert strokemask.ring_contains(exterior, tuple(hole[0]))
+    assert not strokemask.ring_contains(hole, (0.5, 0.5))
+
+
+def test_stroke_mask_stamps_capsule_and_grows():
+    stroke = strokemask.StrokeMask(radius=2, cell_size=1)
+    stroke.add_point(Point(0, 0))
+    stroke.add_point(Point(20, 0))
+    stroke.skip_to(Point(-30, 0))
+    stroke.add_polygon(np.array([[-31.0, -1.0], [-29.0, -1.0], [-29.0, 1.0],
+                                 [-31.0, 1.0]]))
+
+    assert stroke.stamps == 3
+    # A capsule of radius 2 and length 20 covers about 20 * 4 + pi * 4 cells
+    assert 85 <= np.count_nonzero(stroke.mask) - 4 <= 100
+    assert len(strokemask.trace_contours(stroke.mask)) == 2
+
+
+def test_vertex_budget_coarsens_only_up_to_max_tolerance():
+    stroke = strokes.StrokeAccumulator(8, 8, tolerance=0.5, vertex_budget=10,
+                                       settle_size=20)
+    # A zigzag of amplitude 10 cannot be simplified below the budget without
+    # exceeding a quarter of the radius
+    for x in range(20):
+        stroke.add_point(Point(x, 10 * (x % 2)))
+    assert stroke.settle()
+
+    assert stroke.max_tolerance == 2
+    assert stroke.settle_tolerance == 2
+    assert stroke.tolerance == 0.5
+    assert stroke.vertex_count() > stroke.vertex_budget
+
+
+class Extent:
+    def __init__(self, xmin, ymin, xmax, ymax):
+        self.box = (xmin, ymin, xmax, ymax)
+
+    def xMinimum(self):
+        return self.box[0]
+
+    def yMinimum(self):
+        return self.box[1]
+
+    def xMaximum(self):
+        return self.box[2]
+
+    def yMaximum(self):
+        return self.box[3]
+
+    def width(self):
+        return self.box[2] - self.box[0]
+
+    def height(self):
+        return self.box[3] - self.box[1]
+
+    def contains(self, point):
+        return (self.box[0] <= point.x() <= self.box[2] and
+                self.box[1] <= point.y() <= self.box[3])
+
+
+def test_crs_context_resamples_outside_of_the_sampled_extent(monkeypatch):
+    # Distances grow with x: the area scale at x is (1 + x / 100) ** 2
+    def transform_vertices(transform, vertices):
+        x, y = vertices[:, 0], vertices[:, 1]
+        return np.column_stack((x + x * x / 200, y * (1 + x / 100)))
+
+    monkeypatch.setattr(reprojection, "transform_vertices", transform_vertices)
+    context = reprojection.CrsContext("EPSG:4326", "EPSG:3857", grid_size=3)
+
+    assert context.scale_factor_at(Point(0, 0), Extent(0, 0, 100, 100)) \
+        == pytest.approx(1, rel=1e-3)
+    assert context.scale_factor_at(Point(100, 0), Extent(0, 0, 100, 100)) \
+        == pytest.approx(2, rel=1e-3)
+
+    # A point outside the sampled grid is not clamped to its nearest node
+    assert context.scale_factor_at(Point(300, 0), Extent(200, 0, 300, 100)) \
+        == pytest.approx(4, rel=1e-3)
+    assert context.extent.box == (200, 0, 300, 100)
+
+    context.invalidate()
+    assert context.scale_grid is None
+
+
+def test_polygon_rings_reads_multipolygon_wkb():
+    square = [0, 0, 4, 0, 4, 4, 0, 4, 0, 0]
+    hole = [1, 1, 1, 2, 2, 2, 1, 1]
+    wkb = (struct.pack('<BI', 1, 6) + struct.pack('<I', 2) +
+           struct.pack('<BIII10d', 1, 3, 2, 5, *square) +
+           struct.pack('<I8d', 4, *hole) +
+           struct.pack('>BIII10d', 0, 3, 1, 5, *[v + 10 for v in square]))
+    geometry = types.SimpleNamespace(isEmpty=lambda: False, asWkb=lambda: wkb)
+
+    polygons = strokes.polygon_rings(geometry)
+
+    assert [len(rings) for rings in polygons] == [2, 1]
+    assert polygons[0][0].tolist() == [[0, 0], [4, 0], [4, 4], [0, 4]]
+    assert polygons[0][1].tolist() == [[1, 1], [1, 2], [2, 2]]
+    assert polygons[1][0].tolist() == [[10, 10], [14, 10], [14, 14], [10, 14]]
+
+
+def test_shape_template_is_cached_and_read_only():
+    template = strokes.shape_template('circle', 9)
+
+    assert template is strokes.shape_template('circle', 9)
+    assert not template.flags.writeable
+    assert template.shape == (8, 2)
+    assert np.allclose(np.hypot(template[:, 0], template[:, 1]), 1)
+    assert strokes.shape_template('rectangle', 9).shape == (4, 2)
+
+
+def test_stamp_vertices_scales_rotates_and_translates():
+    vertices = strokes.stamp_vertices('wedge', 0, Point(10, 20), 2, angle=90)
+
+    # The tip of the wedge turns clockwise with the brush angle, from east
+    # to south
+    assert vertices[0] == pytest.approx([10, 18])
+    assert np.allclose(np.hypot(vertices[:, 0] - 10, vertices[:, 1] - 20), 2)
+
+
+def test_inner_radius_of_brush_shapes():
+    assert strokes.inner_radius('rectangle', 0) == pytest.approx(0.5)
+    assert strokes.inner_radius('circle', 9) == pytest.approx(np.cos(np.pi / 8))
+    assert 0 < strokes.inner_radius('wedge', 0) < 0.5
+
+
+def test_geometry_unions_the_whole_stroke_once(monkeypatch):
+    unions = []
+
+    class Part:
+        def buffer(self, radius, segments):
+            return "buffered centreline"
+
+    monkeypatch.setattr(strokes, "multilinestring_from_vertices", lambda lines: Part())
+    monkeypatch.setattr(strokes, "multipolygon_from_vertices",
+                        lambda polygons: "swept shapes")
+    monkeypatch.setattr(strokes, "QgsGeometry", types.SimpleNamespace(
+        unaryUnion=lambda parts: unions.append(parts) or "stroke"))
+
+    stroke = strokes.StrokeAccumulator(1, 8)
+    for x in range(100):
+        stroke.add_point(Point(x, 0))
+        stroke.add_polygon(np.array([[x, 0.0], [x + 1, 0.0], [x, 1.0]]))
+    assert unions == []
+
+    assert stroke.geometry() == "stroke"
+    assert unions == [["swept shapes", "buffered centreline"]]
+
+
+def test_merges_never_keep_an_invalid_or_empty_simplification(monkeypatch):
+    class Cells:
+        """Polygon stand-in whose simplification breaks down as the
+        tolerance grows."""
+
+        def __init__(self, cells, valid=True):
+            self.cells = frozenset(cells)
+            self.valid = valid
+
+        def simplify(self, tolerance):
+            if tolerance >= 2:
+                return Cells(())
+            return Cells(self.cells, valid=tolerance < 1)
+
+        def isEmpty(self):
+            return not self.cells
+
+        def isGeosValid(self):
+            return self.valid
+
+        def constGet(self):
+            return types.SimpleNamespace(nCoordinates=lambda: 4 * len(self.cells))
+
+    monkeypatch.setattr(strokes, "multipolygon_from_vertices", lambda polygons: Cells(
+        (int(p[0][0]), int(p[0][1])) for p in polygons))
+    monkeypatch.setattr(strokes, "QgsGeometry", types.SimpleNamespace(
+        unaryUnion=lambda parts: Cells(set().union(*(p.cells for p in parts)))))
+
+    stroke = strokes.StrokeAccumulator(16, 8, tolerance=0.5, vertex_budget=8,
+                                       settle_size=2)
+    for x in range(12):
+        stroke.add_polygon(np.array([[x, 0.0], [x + 1, 0.0], [x, 1.0]]))
+        stroke.settle()
+
+    # The budget pushed the tolerance to where simplifying breaks down
+    assert stroke.settle_tolerance == 4
+    assert stroke.settled_geometry.valid
+    assert stroke.settled_geometry.cells == {(x, 0) for x in range(12)}